@@ -24,27 +24,344 @@ import gobject
 import glib
 import time
 import gio
-import tempfile
+import bisect
+import hashlib
+from stat import S_ISDIR
 import threading
+import sqlite3
+import collections
+import Queue
+import signal
+import socket
+import struct
+import subprocess
+import zlib
+import mmap
+import difflib
+import pango
+import nilfs2
 
 class NILFSException(Exception):
     "A private exception class to pass error information"
     def __init__(self, info):
         Exception.__init__(self,info)
 
+class Pending:
+    """
+    Placeholder yielded by the history generators while they wait for
+    a thread, so that the main loop is not blocked.  A consumer on the
+    main loop hands then() a callback, which is called from an idle
+    callback once the thread is done and goes on with the generator.
+    Other consumers may go on at once, and the generator then waits
+    for the thread itself.  It is false, like the None the generators
+    yield to give the main loop a turn.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def __nonzero__(self):
+        return False
+
+    def set(self):
+        "End the wait and schedule the callbacks"
+        self.lock.acquire()
+        try:
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            glib.idle_add(callback)
+
+    def then(self, callback):
+        "Call @callback from an idle callback once the wait is over"
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        glib.idle_add(callback)
+
+    def wait(self, timeout=None):
+        "Wait for the end of the wait, and return if it ended"
+        return self.event.wait(timeout)
+
+def run_async(func, result, cancel=None):
+    """
+    Call @func on a thread of its own and append what it returns to
+    @result, yielding a Pending until it is done.  An exception raised
+    by @func is raised again here.  Nothing is appended once @cancel
+    is set.
+    """
+    pending = Pending()
+    answer = []
+    def run():
+        try:
+            answer.append((func(), None))
+        except Exception:
+            answer.append((None, sys.exc_info()))
+        pending.set()
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    yield pending
+    while not pending.wait(0.1):
+        if cancel != None and cancel.isSet():
+            return
+    if cancel != None and cancel.isSet():
+        return
+    r = answer[0]
+    if r[1]:
+        raise r[1][0], r[1][1], r[1][2]
+    result.append(r[0])
+
+def ordered_map(func, items, workers, cancel=None, window=None):
+    """
+    Apply @func to each of @items on @workers threads and yield the
+    results in the order of @items.  A Pending is yielded while the
+    next result is not in.  At most @window items are worked on ahead
+    of the consumer.  The threads give up when @cancel is set or the
+    generator is closed.  An exception raised by @func is raised again
+    from the generator.
+    """
+    items = list(items)
+    if window == None:
+        window = workers * 4
+    lock = threading.Lock()
+    room = threading.Condition(lock)   # the consumer moved on
+    results = {}
+    waiting = {}                       # index -> Pending
+    state = {'next': 0, 'consumed': 0, 'stop': False}
+
+    def stopped():
+        return state['stop'] or (cancel != None and cancel.isSet())
+
+    def work():
+        while True:
+            lock.acquire()
+            try:
+                while (not stopped() and state['next'] < len(items) and
+                       state['next'] - state['consumed'] >= window):
+                    room.wait()
+                if stopped() or state['next'] >= len(items):
+                    return
+                i = state['next']
+                state['next'] += 1
+            finally:
+                lock.release()
+            try:
+                r = (func(items[i]), None)
+            except Exception:
+                r = (None, sys.exc_info())
+            lock.acquire()
+            results[i] = r
+            pending = waiting.pop(i, None)
+            lock.release()
+            if pending != None:
+                pending.set()
+
+    for n in range(min(workers, len(items))):
+        t = threading.Thread(target=work)
+        t.setDaemon(True)
+        t.start()
+
+    try:
+        for i in xrange(len(items)):
+            while True:
+                lock.acquire()
+                try:
+                    if results.has_key(i):
+                        r = results.pop(i)
+                        state['consumed'] = i + 1
+                        room.notify()
+                        break
+                    if stopped():
+                        return
+                    pending = waiting[i] = Pending()
+                finally:
+                    lock.release()
+                yield pending
+                while not pending.wait(0.1):
+                    if stopped():
+                        return
+            if r[1]:
+                raise r[1][0], r[1][1], r[1][2]
+            yield r[0]
+    finally:
+        lock.acquire()
+        state['stop'] = True
+        room.notifyAll()
+        lock.release()
+
+class VersionIndex:
+    """
+    Persistent record of what was found in each snapshot.  Snapshots
+    never change, so the mtime and size of a path in a checkpoint, or
+    the fact that it does not exist there, is kept in an SQLite
+    database keyed by volume, checkpoint number and relative path,
+    and by how deep directories were looked into.  A volume is named
+    by volume_id(), so that what was seen on a device is not taken
+    for another file system made on it later.  Errors from the
+    database are reported and otherwise ignored.  A database of an
+    older layout is emptied, since it only holds what can be found
+    again.
+    """
+    SCHEMA = 3
+
+    def __init__(self, path):
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        self.db = sqlite3.connect(path, timeout=5)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA:
+            self.db.execute("DROP TABLE IF EXISTS versions")
+            self.db.execute("DROP TABLE IF EXISTS fingerprints")
+            self.db.execute("PRAGMA user_version = %d" % self.SCHEMA)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS versions (
+                               dev TEXT, cno INTEGER, relpath TEXT,
+                               depth INTEGER, mtime REAL, size INTEGER,
+                               PRIMARY KEY (dev, cno, relpath, depth))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+                               dev TEXT, cno INTEGER, relpath TEXT,
+                               sample TEXT, digest TEXT,
+                               PRIMARY KEY (dev, cno, relpath))""")
+        self.db.commit()
+
+    def lookup(self, dev, relpath, depth=1):
+        """
+        Return a dictionary mapping checkpoint numbers to a pair
+        (mtime, size), or None where @relpath does not exist.  @depth
+        is the one given to NILFSMounts.get_dir_info().
+        """
+        try:
+            rows = self.db.execute("""SELECT cno, mtime, size FROM versions
+                                      WHERE dev = ? AND relpath = ?
+                                      AND depth = ?""",
+                                   (dev, relpath, depth))
+            return dict((cno, None if mtime == None else (mtime, size))
+                        for (cno, mtime, size) in rows)
+        except sqlite3.Error, (e):
+            sys.stderr.write("version index: %s\n" % e)
+            return {}
+
+    def store(self, dev, relpath, found, depth=1):
+        "Record @found, a dictionary in the form lookup() returns"
+        if not found:
+            return
+        rows = [(dev, cno, relpath, depth) + (v or (None, None))
+                for (cno, v) in found.iteritems()]
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO versions "
+                                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+        except sqlite3.Error, (e):
+            sys.stderr.write("version index: %s\n" % e)
+
+    def fingerprint(self, dev, cno, relpath):
+        """
+        Return a pair of the sampled and the full content hash of
+        @relpath in checkpoint @cno, either of which may be None, or
+        None if neither is known.
+        """
+        try:
+            return self.db.execute("""SELECT sample, digest FROM fingerprints
+                                      WHERE dev = ? AND cno = ?
+                                      AND relpath = ?""",
+                                   (dev, cno, relpath)).fetchone()
+        except sqlite3.Error, (e):
+            sys.stderr.write("version index: %s\n" % e)
+            return None
+
+    def store_fingerprint(self, dev, cno, relpath, sample, digest):
+        try:
+            self.db.execute("INSERT OR REPLACE INTO fingerprints "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (dev, cno, relpath, sample, digest))
+            self.db.commit()
+        except sqlite3.Error, (e):
+            sys.stderr.write("version index: %s\n" % e)
+
+    def expire(self, dev, cnos):
+        "Forget checkpoints of @dev other than @cnos"
+        cnos = set(cnos)
+        try:
+            rows = self.db.execute("SELECT DISTINCT cno FROM versions "
+                                   "WHERE dev = ?", (dev,))
+            gone = [(dev, cno) for (cno,) in rows if cno not in cnos]
+            if gone:
+                self.db.executemany("DELETE FROM versions "
+                                    "WHERE dev = ? AND cno = ?", gone)
+                self.db.executemany("DELETE FROM fingerprints "
+                                    "WHERE dev = ? AND cno = ?", gone)
+                self.db.commit()
+        except sqlite3.Error, (e):
+            sys.stderr.write("version index: %s\n" % e)
+
+def volume_id(dev, by_uuid='/dev/disk/by-uuid'):
+    """
+    Return a name of the file system on @dev for the version index:
+    its UUID as linked under @by_uuid, or the device name itself if
+    it has no link there.
+    """
+    dev = os.path.realpath(dev)
+    try:
+        names = os.listdir(by_uuid)
+    except OSError:
+        names = []
+    for name in names:
+        if os.path.realpath(os.path.join(by_uuid, name)) == dev:
+            return 'UUID=' + name
+    return dev
+
+__version_index__ = []
+
+def get_version_index():
+    """
+    Return the version index under the user cache directory, shared
+    by all property pages, or None if it can not be opened.
+    """
+    if not __version_index__:
+        cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.expanduser('~/.cache'))
+        path = os.path.join(cache, 'TimeBrowse', 'versions.db')
+        try:
+            __version_index__.append(VersionIndex(path))
+        except (OSError, sqlite3.Error), (e):
+            sys.stderr.write("can not open version index %s: %s\n" %
+                             (path, e))
+            __version_index__.append(None)
+    return __version_index__[0]
+
 class NILFSMounts:
     "NILFS Snapshot enumerator class"
-    def __init__(self):
-        self.nilfs_entry_regex = re.compile('^ *([^ ]+) +([^ ]+) +nilfs2 +([^ ]+) +([^ ]+) +([^ ]+) *$', re.M)
-        self.cp_regex = re.compile('.*cp=.*')
-        self.nilfs_cp_entry_regex = re.compile('^ *([^ ]+) +([^ ]+) +nilfs2 +([^ ]*cp=([\d]+)[^ ]*) +([^ ]+) +([^ ]+) *$', re.M)
+    SAMPLE_SIZE = 4096
+    LISTINGS = 64     # directory listings kept by __list_dir__()
+
+    def __init__(self, exhaustive=False, workers=4, index=None,
+                 dedup=False, hash_limit=16 << 20, dir_depth=1):
+        self.mount_table = nilfs2.get_mount_table()
+        self.exhaustive = exhaustive
+        self.workers = workers
+        self.index = index
+        self.dedup = dedup
+        self.hash_limit = hash_limit
+        self.dir_depth = dir_depth
+        self.fingerprints = {}
+        self.listings = collections.OrderedDict()
+        self.listings_lock = threading.Lock()
+        self.lazy_mounts = {}
 
     def find_nilfs_in_mtab(self):
         """
         List all mount points of NILFS snapshots which appear in
-        /proc/mounts.  This method first finds NILFS volumes in
-        /etc/mtab, then enumerates all snapshot mounts for each NILFS
-        volume by using /proc/mounts.
+        the mount table.  This method first finds NILFS volumes, then
+        enumerates all snapshot mounts for each NILFS volume.  The
+        mount table is shared and parsed again only when it changes.
 
         On success, a list of mount point dictionaries will be
         returned in the following form:
@@ -67,39 +384,21 @@ class NILFSMounts:
 
         On error, this method will raise a NILFSException exception.
         """
-        with open("/etc/mtab") as f:
-            entries = self.nilfs_entry_regex.findall(f.read())
+        actives = [{'dev' : e.dev, 'mp' : e.mp}
+                   for e in self.mount_table.nilfs_volumes()]
 
-        # Device paths and mount points in mtab are normalized
-        actives = [{'dev' : str(e[0]), 'mp' : str(e[1])}
-                    for e in entries if not self.cp_regex.match(e[2])]
-   
         if len(actives) == 0:
             raise NILFSException("can not find active NILFS volume in mtab")
 
         # sort by mount point length. the longer, the earlier
-        actives.sort(lambda a, b: -cmp(len(a['mp']), len(b['mp'])))
-
-        # Make a dictionary of checkpoints sorted by device name
-        # from /proc/mounts
-        checkpoints = {}
-        with open("/proc/mounts") as f:
-            ms = self.nilfs_cp_entry_regex.findall(f.read())
-            for m in ms:
-                cpinfo = m[1], int(m[3])
-                dev = m[0]
-                if dev in checkpoints:
-                    checkpoints[dev].append(cpinfo)
-                else:
-                    checkpoints[dev] = [cpinfo]
-
-        # Sort checkpoints by checkpoint number
-        for cps in checkpoints.itervalues():
-            cps.sort(lambda a, b: cmp(a[1], b[1]))
+        actives.sort(key=lambda a: len(a['mp']), reverse=True)
 
+        # Checkpoints are indexed by device name and sorted by
+        # checkpoint number in the mount table
         for a in actives:
-            if a['dev'] in checkpoints:
-                a['cps'] = checkpoints[a['dev']]
+            cps = self.mount_table.nilfs_snapshots(a['dev'])
+            if cps:
+                a['cps'] = list(cps)
 
         return actives
 
@@ -116,6 +415,63 @@ class NILFSMounts:
                 return e 
         raise NILFSException("file not in NILFS volume: %s" % realpath)
 
+    def find_snapshots_from_manager(self, realpath):
+        """
+        Ask the snapshot manager daemon for the snapshots of the NILFS
+        volume holding @realpath.  Return a tuple of the device and
+        mount point of the volume and a list of cpinfo tuples as in
+        find_nilfs_in_mtab(), or None if the daemon is not available.
+        Snapshots left unmounted by a lazily mounting daemon are given
+        as (None, <checkpoint number>, <device>) and mounted when they
+        are first probed.  This waits for the daemon, so get_history()
+        calls it on a thread.
+        """
+        try:
+            client = nilfs2.ControlClient()
+            try:
+                r = client.request({'cmd': 'versions', 'path': realpath})
+            finally:
+                client.close()
+        except (IOError, ValueError, UnicodeError):
+            return None
+        if 'error' in r:
+            return None
+        dev = r['device'].encode('utf-8')
+        return (dev, r['mp'].encode('utf-8'),
+                [(mp.encode('utf-8'), cno) if mp else (None, cno, dev)
+                 for mp, cno in r['snapshots']])
+
+    def __mount_point__(self, cp):
+        """
+        Return the mount point of the snapshot @cp if it is known
+        without asking the daemon, or None.
+        """
+        return cp[0] or self.lazy_mounts.get((cp[2], cp[1]))
+
+    def __snapshot_path__(self, cp):
+        """
+        Return the mount point of the snapshot @cp, asking the daemon
+        to mount it if it is not mounted yet, or None if that failed.
+        This may wait for the daemon, so it is only called on threads.
+        """
+        if cp[0]:
+            return cp[0]
+        key = (cp[2], cp[1])
+        mp = self.lazy_mounts.get(key)
+        if mp == None:
+            try:
+                client = nilfs2.ControlClient(timeout=30.0)
+                try:
+                    r = client.request({'cmd': 'mount', 'device': cp[2],
+                                        'cno': cp[1]})
+                finally:
+                    client.close()
+            except (IOError, ValueError, UnicodeError):
+                return None
+            if 'error' in r:
+                return None
+            mp = self.lazy_mounts[key] = r['mp'].encode('utf-8')
+        return mp
 
 
     def age_repr(self, val, unit):
@@ -143,20 +499,85 @@ class NILFSMounts:
         y = time/365
         return self.age_repr(y, "year")
 
-    def get_dir_info(self, directory):
+    def get_dir_info(self, directory, depth=None):
         """
         Return update time and size of a directory.  The update time
-        is currently calculated as the latest mtime of the directory
-        and its child nodes.
+        is calculated as the latest mtime of the directory and the
+        nodes below it, down to @depth levels (self.dir_depth when not
+        given).  Depth 0 looks at the directory alone, and 1 at its
+        child nodes as well.
         """
+        if depth == None:
+            depth = self.dir_depth
         stat = os.stat(directory)
+        return (self.__newest_mtime__(directory, stat, depth), stat.st_size)
+
+    def __newest_mtime__(self, directory, stat, depth):
+        """
+        Return the latest mtime of @directory, whose stat result is
+        @stat, and the nodes below it down to @depth levels.  The
+        entries are lstat'ed in any case, since writing to a file
+        leaves the directory alone, but when the inode number and
+        ctime of each of them are the same as in the snapshot before,
+        the newest mtime found there is used again.  That is only kept
+        when no subdirectory was looked into, as the ctime of a
+        subdirectory does not tell what changed below it.
+        """
         newest = stat.st_mtime
-        size = stat.st_size
-        for e in os.listdir(directory):
-            mtime = os.lstat("%s/%s" % (directory, e)).st_mtime
+        if depth <= 0:
+            return newest
+        prefix = directory + '/'
+        lstat = os.lstat
+        listing = self.__list_dir__(directory, stat)
+        stats = [lstat(prefix + e) for e in listing['names']]
+        children = [(s.st_ino, s.st_ctime) for s in stats]
+        if listing['children'] == children:
+            return listing['newest']
+        descended = False
+        for (e, s) in zip(listing['names'], stats):
+            if depth > 1 and S_ISDIR(s.st_mode):
+                mtime = self.__newest_mtime__(prefix + e, s, depth - 1)
+                descended = True
+            else:
+                mtime = s.st_mtime
             if newest < mtime:
                 newest = mtime
-        return (newest, size)
+        if not descended:
+            listing['children'] = children
+            listing['newest'] = newest
+        return newest
+
+    def __list_dir__(self, directory, stat):
+        """
+        Return the listing of @directory, whose stat result is @stat,
+        as a dictionary of its entry 'names' and, as kept by
+        __newest_mtime__(), the 'children' seen last time and the
+        'newest' mtime found with them.  The same directory in the
+        next snapshot has the same entries unless its mtime or ctime
+        moved, so a listing is kept and used again for a directory
+        whose inode number, times, size and link count all match.
+        The last self.LISTINGS listings used are kept.
+        """
+        key = (stat.st_ino, stat.st_mtime, stat.st_ctime, stat.st_size,
+               stat.st_nlink)
+        self.listings_lock.acquire()
+        try:
+            listing = self.listings.pop(key, None)
+            if listing != None:
+                self.listings[key] = listing
+                return listing
+        finally:
+            self.listings_lock.release()
+        listing = {'names': os.listdir(directory), 'children': None,
+                   'newest': None}
+        self.listings_lock.acquire()
+        try:
+            self.listings[key] = listing
+            while len(self.listings) > self.LISTINGS:
+                self.listings.popitem(last=False)
+        finally:
+            self.listings_lock.release()
+        return listing
 
     def get_file_info(self, path):
         """
@@ -170,121 +591,783 @@ class NILFSMounts:
             stat = os.lstat(path)
             return (stat.st_mtime, stat.st_size)
   
-    def list_history(self, cps, relpath):
+    def __probe__(self, cp, relpath):
         """
-        Make a version list entry of the given object with a relative
-        path @relpath, and return it in a coroutine manner.
+        Return a tuple (path, mtime, size) of @relpath in the snapshot
+        @cp, or None if it does not exist there.
+        """
+        mp = self.__snapshot_path__(cp)
+        if mp == None:
+            return None
+        f = mp + '/' + relpath
+        if not os.path.exists(f):
+            return None
+        (mtime, size) = self.get_file_info(f)
+        return (f, mtime, size)
 
-        The version list entry is a dictionary in the following form:
+    def __known_probe__(self, cp, relpath, known):
+        """
+        Probe @cp unless @known, a dictionary in the form
+        VersionIndex.lookup() returns, already has the answer, and
+        record the answer there.  A snapshot answered from @known is
+        not mounted for it; the path is None if it is not mounted yet,
+        see __listed__().
+        """
+        if known.has_key(cp[1]):
+            found = known[cp[1]]
+            if not found:
+                return found
+            mp = self.__mount_point__(cp)
+            return (mp and mp + '/' + relpath,) + found
+        probed = self.__probe__(cp, relpath)
+        known[cp[1]] = probed and probed[1:]
+        return probed
+
+    def __probe_async__(self, cp, relpath, known, result, cancel=None):
+        """
+        Append what __known_probe__() returns for @cp to @result.  A
+        snapshot which has to be mounted first is probed on a thread,
+        yielding a Pending meanwhile, so that the main loop does not
+        wait for the daemon.  Nothing is appended if @cancel is set.
+        """
+        if known.has_key(cp[1]) or self.__mount_point__(cp):
+            result.append(self.__known_probe__(cp, relpath, known))
+            return
+        for w in run_async(lambda: self.__probe__(cp, relpath), result,
+                           cancel):
+            yield w
+        if result:
+            known[cp[1]] = result[0] and result[0][1:]
 
-          { 'path': <pathname>, 'mtime': <mtime>, 'size': <filesize>,
-            'age': <string representing age of the object> }
+    def __listed__(self, probed, cp, relpath, current_time, cancel=None):
         """
-        current_time = time.time()
-        last_mtime = current_time
+        Yield the history entry of @probed, as found in @cp.  A
+        snapshot answered from the version index is only mounted here,
+        on a thread, when its version is listed.  Nothing is listed if
+        it cannot be mounted.
+        """
+        if probed[0] == None:
+            mp = []
+            for w in run_async(lambda: self.__snapshot_path__(cp), mp,
+                               cancel):
+                yield w
+            if not mp or mp[0] == None:
+                return
+            probed = (mp[0] + '/' + relpath,) + probed[1:]
+        yield self.__history_entry__(probed, cp[1], current_time)
+
+    def __history_entry__(self, probed, cno, current_time):
+        (f, mtime, size) = probed
+        return {'path' : f, 'mtime' : mtime, 'size' : size, 'cno' : cno,
+                'age' : self.pretty_format(current_time - mtime)}
+
+    def __hash_file__(self, path, size, full):
+        """
+        Return a hash of the file on @path of @size bytes.  Unless
+        @full is set, only a block at the beginning, in the middle and
+        at the end of the file is read.
+        """
+        h = hashlib.sha1(str(size))
+        f = open(path, 'rb')
+        try:
+            if full:
+                while True:
+                    buf = f.read(65536)
+                    if not buf:
+                        break
+                    h.update(buf)
+            else:
+                for off in (0, size / 2, size - self.SAMPLE_SIZE):
+                    f.seek(max(off, 0))
+                    h.update(f.read(self.SAMPLE_SIZE))
+        finally:
+            f.close()
+        return h.hexdigest()
+
+    def __fingerprint__(self, entry, dev, relpath, full, indexed=True):
+        """
+        Return the sampled, or with @full the complete, content hash
+        of a version list entry.  Hashes are kept for the lifetime of
+        this object, and in the version index when @dev is given,
+        unless @indexed is cleared.
+        """
+        key = (dev, entry['cno'], relpath)
+        fp = self.fingerprints.get(key)
+        indexed = indexed and self.index and dev
+        if fp == None and indexed:
+            fp = self.index.fingerprint(dev, entry['cno'], relpath)
+        fp = list(fp or (None, None))
+        i = 1 if full else 0
+        if fp[i] == None:
+            fp[i] = self.__hash_file__(entry['path'], entry['size'], full)
+            if indexed:
+                self.index.store_fingerprint(dev, entry['cno'], relpath,
+                                             fp[0], fp[1])
+        self.fingerprints[key] = fp
+        return fp[i]
+
+    def same_content(self, a, b, dev, relpath, indexed=True):
+        """
+        Tell whether the version list entries @a and @b of the regular
+        file @relpath hold the same bytes.  The sizes and then sampled
+        hashes are compared first; the whole files are only hashed
+        when those agree, and never when larger than self.hash_limit.
+        The version index is left alone unless @indexed is set.
+        """
+        if a['size'] != b['size'] or a['size'] > self.hash_limit:
+            return False
+        for e in (a, b):
+            if os.path.islink(e['path']) or not os.path.isfile(e['path']):
+                return False
+        try:
+            if (self.__fingerprint__(a, dev, relpath, False, indexed) !=
+                self.__fingerprint__(b, dev, relpath, False, indexed)):
+                return False
+            if a['size'] <= 3 * self.SAMPLE_SIZE:
+                return True   # the samples covered the whole file
+            return (self.__fingerprint__(a, dev, relpath, True, indexed) ==
+                    self.__fingerprint__(b, dev, relpath, True, indexed))
+        except IOError:
+            return False
+
+    def __same_content_async__(self, a, b, dev, relpath, result,
+                               cancel=None):
+        """
+        Compare @a and @b by same_content() on a thread of its own,
+        yielding a Pending until it is done, so that the files are not
+        read on the main loop.  The answer is appended to @result
+        unless @cancel is set first.  The version index is only used
+        here, since its connection belongs to this thread.
+        """
+        keys = [(dev, e['cno'], relpath) for e in (a, b)]
+        if self.index and dev:
+            for key in keys:
+                if not self.fingerprints.has_key(key):
+                    fp = self.index.fingerprint(*key)
+                    if fp:
+                        self.fingerprints[key] = list(fp)
+        before = [tuple(self.fingerprints.get(key) or ()) for key in keys]
+        answer = []
+        for w in run_async(lambda: self.same_content(a, b, dev, relpath,
+                                                     False),
+                           answer, cancel):
+            yield w
+        if not answer:
+            return
+        if self.index and dev:
+            for key, old in zip(keys, before):
+                fp = self.fingerprints.get(key)
+                if fp and tuple(fp) != old:
+                    self.index.store_fingerprint(dev, key[1], relpath,
+                                                 fp[0], fp[1])
+        result.extend(answer)
+
+    def __scan_history__(self, cps, relpath, current_time, last_mtime,
+                         known, cancel=None):
+        """
+        Look at every snapshot in turn.  With more than one worker the
+        snapshots not in @known are probed on a pool of threads while
+        the results are still taken in order.
+        """
+        if self.workers > 1:
+            pending = ordered_map(lambda cp: self.__probe__(cp, relpath),
+                                  [cp for cp in cps
+                                   if not known.has_key(cp[1])],
+                                  self.workers, cancel)
+        else:
+            pending = None
         unyield_count = 0
         for cp in cps:
-            f = cp[0] + '/' + relpath
-            if os.path.exists(f):
-                (mtime, size) = self.get_file_info(f)
+            if pending and not known.has_key(cp[1]):
+                probed = pending.next()
+                while isinstance(probed, Pending):
+                    yield probed
+                    probed = pending.next()
+                known[cp[1]] = probed and probed[1:]
+            else:
+                r = []
+                for w in self.__probe_async__(cp, relpath, known, r, cancel):
+                    yield w
+                if not r:
+                    return
+                probed = r[0]
+            if probed:
+                mtime = probed[1]
                 if last_mtime != mtime:
-                    entry = {'path' : f, 'mtime' : mtime, 'size' : size,
-                             'age' : self.pretty_format(current_time - mtime)}
                     unyield_count = 0
-                    yield entry
+                    for e in self.__listed__(probed, cp, relpath,
+                                             current_time, cancel):
+                        yield e
                 last_mtime = mtime
             if (unyield_count&0xFF) == 0xFF:
                 unyield_count = 0
                 yield None
             unyield_count += 1
 
-    def get_history(self, path):
+    def __bisect_history__(self, cps, relpath, current_time, known,
+                           cancel=None):
+        """
+        Find the snapshots where the object changes by bisection.
+        Since the mtime of an object only grows from one snapshot to
+        the next, a range of snapshots whose first and last members
+        agree has no change in between and is skipped without looking
+        inside, unless the object is missing at both ends, as it may
+        have existed in between.  This takes O(k log n) probes for k
+        versions in n snapshots.  Should the mtime go backwards, e.g. for a restored
+        file, the rest of the snapshots are scanned one by one.
+        Ranges are split at the snapshot in @known nearest to their
+        middle, so that a history seen before costs only a few probes
+        of the snapshots taken since.  The snapshots are probed by
+        fetch(), which yields while one is mounted, before probe()
+        and key() look at them.
+        """
+        probed = {}
+        def fetch(*indexes):
+            for i in indexes:
+                if i not in probed:
+                    r = []
+                    for w in self.__probe_async__(cps[i], relpath, known, r,
+                                                  cancel):
+                        yield w
+                    if not r:
+                        return
+                    probed[i] = r[0]
+        def stopped():
+            return cancel != None and cancel.isSet()
+        def probe(i):
+            return probed[i]
+        def key(i):
+            p = probe(i)
+            return p and p[1]
+
+        def split(lo, hi):
+            mid = (lo + hi) / 2
+            j = bisect.bisect_left(free, mid)
+            near = [i for i in free[max(j - 1, 0):j + 1] if lo < i < hi]
+            if near:
+                return min(near, key=lambda i: abs(i - mid))
+            return mid
+        free = [i for (i, cp) in enumerate(cps) if known.has_key(cp[1])]
+
+        last = len(cps) - 1
+        for w in fetch(0, last):
+            yield w
+        if stopped():
+            return
+        if key(0) == None and key(last) == None:
+            # nothing to bisect on; the object may still live in between
+            for e in self.__scan_history__(cps, relpath, current_time,
+                                           current_time, known, cancel):
+                yield e
+            return
+
+        last_mtime = current_time
+        if probe(0):
+            last_mtime = key(0)
+            for e in self.__listed__(probe(0), cps[0], relpath,
+                                     current_time, cancel):
+                yield e
+
+        unyield_count = 0
+        ranges = [(0, last)]
+        while ranges:
+            (lo, hi) = ranges.pop()
+            for w in fetch(lo, hi):
+                yield w
+            if stopped():
+                return
+            if key(lo) == key(hi) and key(lo) is not None:
+                pass
+            elif hi - lo > 1:
+                mid = split(lo, hi)
+                # left half is popped first so that versions come in order
+                ranges.append((mid, hi))
+                ranges.append((lo, mid))
+            elif probe(hi):
+                mtime = key(hi)
+                if last_mtime != current_time and mtime < last_mtime:
+                    for e in self.__scan_history__(cps[hi:], relpath,
+                                                   current_time, last_mtime,
+                                                   known, cancel):
+                        yield e
+                    return
+                if last_mtime != mtime:
+                    unyield_count = 0
+                    for e in self.__listed__(probe(hi), cps[hi], relpath,
+                                             current_time, cancel):
+                        yield e
+                last_mtime = mtime
+            if (unyield_count&0xF) == 0xF:
+                unyield_count = 0
+                yield None
+            unyield_count += 1
+
+    def list_history(self, cps, relpath, exhaustive=None, cancel=None,
+                     dev=None):
+        """
+        Make a version list entry of the given object with a relative
+        path @relpath, and return it in a coroutine manner.
+
+        The version list entry is a dictionary in the following form:
+
+          { 'path': <pathname>, 'mtime': <mtime>, 'size': <filesize>,
+            'cno': <checkpoint number>,
+            'age': <string representing age of the object> }
+
+        Versions are found by bisection unless @exhaustive (or
+        self.exhaustive when not given) is set, in which case the
+        object is looked up in every snapshot.  Setting the event
+        @cancel stops the threads probing the snapshots.
+
+        When the volume @dev, as named by volume_id(), is given,
+        snapshots already in the version index are not probed again,
+        and what is found in the others is added to the index.
+
+        With self.dedup set, a version whose content is the same as
+        the one listed before it, e.g. after a mere touch, is left out.
+        """
+        if exhaustive == None:
+            exhaustive = self.exhaustive
+        current_time = time.time()
+        if not cps:
+            return
+        known = {}
+        if self.index and dev:
+            known = self.index.lookup(dev, relpath, self.dir_depth)
+        indexed = set(known)
+        if exhaustive:
+            gen = self.__scan_history__(cps, relpath, current_time,
+                                        current_time, known, cancel)
+        else:
+            gen = self.__bisect_history__(cps, relpath, current_time,
+                                          known, cancel)
+        try:
+            shown = None
+            for e in gen:
+                if e and self.dedup:
+                    if shown:
+                        same = []
+                        for w in self.__same_content_async__(
+                                shown, e, dev, relpath, same, cancel):
+                            yield w
+                        if same and same[0]:
+                            yield None
+                            continue
+                    shown = e
+                yield e
+        finally:
+            if self.index and dev:
+                self.index.store(dev, relpath,
+                                 dict((cno, v) for (cno, v) in known.iteritems()
+                                      if cno not in indexed),
+                                 self.dir_depth)
+
+    def get_history(self, path, cancel=None):
         """
-        Get a version list entry of the object on @path if it's stored
-        in a nilfs volume.
+        Yield the version list entries of the object on @path if it's
+        stored in a nilfs volume, as list_history() does.  The daemon
+        is asked for the snapshots on a thread, yielding a Pending
+        meanwhile.  See list_history() for @cancel.
         """
         try:
             realpath = os.path.realpath(path)
-            mounts = self.find_nilfs_mounts(realpath)
-            relpath = os.path.relpath(realpath, mounts['mp'])
-            return  self.list_history(mounts['cps'], relpath)
+            found = []
+            for w in run_async(
+                    lambda: self.find_snapshots_from_manager(realpath),
+                    found, cancel):
+                yield w
+            if not found:
+                return
+            if found[0]:
+                dev, mp, cps = found[0]
+            else:
+                mounts = self.find_nilfs_mounts(realpath)
+                dev, mp, cps = mounts['dev'], mounts['mp'], mounts['cps']
+            volume = None
+            if self.index:
+                volume = volume_id(dev)
+                self.index.expire(volume, [cp[1] for cp in cps])
+            relpath = os.path.relpath(realpath, mp)
 
         except KeyError, (e):
             sys.stderr.write("configuration is not valid. missig %s key\n" % e)
+            return
 
         except NILFSException, (e):
             sys.stderr.write(str(e) + "\n")
+            return
+
+        for e in self.list_history(cps, relpath, cancel=cancel, dev=volume):
+            yield e
+
+class ThumbnailCache:
+    """
+    Two tier cache of thumbnail pixbufs.  Recently used ones are kept
+    in memory up to @memory_budget bytes of pixel data, and every one
+    stored is also written as a PNG file under @cache_dir, which is
+    trimmed to @disk_budget bytes by dropping the least recently used
+    files.  A key names the content, e.g. a path in a snapshot along
+    with its mtime and size.  self.stats counts hits and misses.
+    The cache may be used from several threads.
+    """
+    def __init__(self, cache_dir, memory_budget=64 << 20,
+                 disk_budget=256 << 20):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory = collections.OrderedDict()
+        self.memory_used = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                      'memory_evictions': 0, 'disk_evictions': 0}
+        self.disk_used = None   # counted on first write
+        self.lock = threading.RLock()
+
+    def __cache_file__(self, key):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(repr(key)).hexdigest() + '.png')
+
+    def __remember__(self, key, pix):
+        self.lock.acquire()
+        try:
+            self.__insert__(key, pix)
+        finally:
+            self.lock.release()
+
+    def __insert__(self, key, pix):
+        if self.memory.has_key(key):
+            self.memory_used -= self.memory.pop(key)[1]
+        size = pix.get_rowstride() * pix.get_height()
+        self.memory[key] = (pix, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_budget and len(self.memory) > 1:
+            (k, (p, size)) = self.memory.popitem(last=False)
+            self.memory_used -= size
+            self.stats['memory_evictions'] += 1
+
+    def get(self, key, disk=True):
+        """
+        Return the pixbuf stored under @key, or None.  Unless @disk is
+        set, only the memory is looked into.
+        """
+        self.lock.acquire()
+        try:
+            if self.memory.has_key(key):
+                entry = self.memory.pop(key)
+                self.memory[key] = entry
+                self.stats['memory_hits'] += 1
+                return entry[0]
+            if not disk:
+                return None
+        finally:
+            self.lock.release()
+        f = self.__cache_file__(key)
+        try:
+            pix = gtk.gdk.pixbuf_new_from_file(f)
+            os.utime(f, None)
+        except (glib.GError, OSError):
+            self.stats['misses'] += 1
+            return None
+        self.stats['disk_hits'] += 1
+        self.__remember__(key, pix)
+        return pix
 
-        return None
+    def put(self, key, pix, persist=True):
+        """
+        Store @pix under @key, in memory only unless @persist is set.
+        """
+        self.__remember__(key, pix)
+        if not persist:
+            return
+        f = self.__cache_file__(key)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp = '%s.%d.tmp' % (f, threading.current_thread().ident)
+            pix.save(tmp, 'png')
+            os.rename(tmp, f)
+            self.lock.acquire()
+            try:
+                if self.disk_used == None:
+                    self.__trim_disk__()
+                else:
+                    self.disk_used += os.path.getsize(f)
+                    if self.disk_used > self.disk_budget:
+                        self.__trim_disk__()
+            finally:
+                self.lock.release()
+        except (glib.GError, OSError), (e):
+            sys.stderr.write("can not store thumbnail %s: %s\n" % (f, e))
+
+    def __trim_disk__(self):
+        files = []
+        for e in os.listdir(self.cache_dir):
+            f = os.path.join(self.cache_dir, e)
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        files.sort()
+        self.disk_used = sum(size for (mtime, size, f) in files)
+        for (mtime, size, f) in files:
+            if self.disk_used <= self.disk_budget:
+                break
+            try:
+                os.unlink(f)
+            except OSError:
+                continue
+            self.disk_used -= size
+            self.stats['disk_evictions'] += 1
+
+class DocumentConverter:
+    """
+    Render the first page of documents as PNG images.  Office and text
+    documents go through a long lived "unoconv --listener", which is
+    started here, checked before each use and started again when it
+    has died or stopped answering on its port.  The PDF unoconv writes
+    is piped straight into pdftoppm, which renders it at the size it
+    is shown at.
+    """
+    RESTART_INTERVAL = 10  # seconds between listener restarts
+    STARTUP_GRACE = 30     # seconds a new listener may take to listen
+    TIMEOUT = 60           # seconds a conversion may take
+
+    def __init__(self, lang=None, unoconv='unoconv', pdftoppm='pdftoppm',
+                 port=2002):
+        self.unoconv = unoconv
+        self.pdftoppm = pdftoppm
+        self.port = port
+        self.env = dict(os.environ)
+        if lang:
+            self.env['LANG'] = lang
+        self.listener = None
+        self.started = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        "Start the listener unless it is running"
+        if self.listener != None and self.listener.poll() == None:
+            return
+        devnull = open(os.devnull, 'r+')
+        try:
+            self.listener = subprocess.Popen(
+                [self.unoconv, '--listener', '--port', str(self.port)],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                env=self.env, close_fds=True, preexec_fn=os.setpgrp)
+        except OSError, (e):
+            sys.stderr.write("can not start %s: %s\n" % (self.unoconv, e))
+            self.listener = None
+        finally:
+            devnull.close()
+        self.started = time.time()
+
+    def stop(self):
+        "Stop the listener along with the office suite it started"
+        if self.listener != None:
+            self.__killpg__(self.listener, signal.SIGTERM)
+            self.listener.wait()
+        self.listener = None
+
+    def __killpg__(self, proc, sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+
+    def healthy(self):
+        """
+        Tell whether the listener runs and, once it had the time to
+        get ready, accepts connections.
+        """
+        if self.listener == None or self.listener.poll() != None:
+            return False
+        if time.time() - self.started < self.STARTUP_GRACE:
+            return True
+        try:
+            socket.create_connection(('127.0.0.1', self.port), 1).close()
+        except socket.error:
+            return False
+        return True
+
+    def check(self):
+        "Restart an unhealthy listener, but not too often"
+        self.lock.acquire()
+        try:
+            if self.healthy():
+                return
+            if time.time() - self.started < self.RESTART_INTERVAL:
+                return
+            if self.listener != None:
+                sys.stderr.write("restarting unoconv listener\n")
+                self.restarts += 1
+            self.stop()
+            self.start()
+        finally:
+            self.lock.release()
+
+    def __pipe__(self, cmds):
+        """
+        Run the commands in @cmds with the output of each fed to the
+        next, and return the output of the last one.  None is returned
+        when one of them fails or they take longer than TIMEOUT.  Each
+        command runs in a process group of its own, so that whatever
+        it starts is killed along with it.
+        """
+        devnull = open(os.devnull, 'w')
+        procs = []
+        try:
+            stdin = None
+            for cmd in cmds:
+                p = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                                     stderr=devnull, env=self.env,
+                                     close_fds=True, preexec_fn=os.setpgrp)
+                if stdin != None:
+                    stdin.close()
+                stdin = p.stdout
+                procs.append(p)
+        except OSError, (e):
+            sys.stderr.write("can not run %s: %s\n" % (cmd[0], e))
+            for p in procs:
+                self.__killpg__(p, signal.SIGKILL)
+                p.wait()
+            return None
+        finally:
+            devnull.close()
+
+        def kill():
+            for p in procs:
+                self.__killpg__(p, signal.SIGKILL)
+        timer = threading.Timer(self.TIMEOUT, kill)
+        timer.start()
+        try:
+            out = procs[-1].stdout.read()
+            procs[-1].stdout.close()
+            status = [p.wait() for p in procs]
+        finally:
+            timer.cancel()
+        if [s for s in status if s != 0]:
+            return None
+        return out
+
+    def render(self, path, size, pdf=False):
+        """
+        Return PNG data of the first page of the document on @path,
+        scaled to fit in a square of @size pixels, or None.  Set @pdf
+        if the document is a PDF already.
+        """
+        pdftoppm = [self.pdftoppm, '-png', '-f', '1', '-l', '1',
+                    '-scale-to', str(size)]
+        if pdf:
+            return self.__pipe__([pdftoppm + [path]])
+        self.check()
+        return self.__pipe__([[self.unoconv, '--port', str(self.port),
+                               '--stdout', '-f', 'pdf', path],
+                              pdftoppm + ['-']])
+
+def blank_png(width, height):
+    "Return PNG data of a white image"
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    rows = ('\0' + '\xff' * (width * 3)) * height
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows)) +
+            chunk('IEND', ''))
+
+class FakeConverter(DocumentConverter):
+    """
+    Stand-in for DocumentConverter that needs neither unoconv nor
+    pdftoppm, for testing.  Every document renders as a blank page,
+    and the paths rendered are kept in self.rendered.
+    """
+    def __init__(self):
+        DocumentConverter.__init__(self)
+        self.rendered = []
+
+    def start(self):
+        pass
+
+    def check(self):
+        pass
+
+    def render(self, path, size, pdf=False):
+        self.rendered.append(path)
+        return blank_png(size * 3 / 4, size)
 
 class PixbufFactory:
-    def __init__(self, lang=None):
-        self.thumbnail_cache = {}
+    # thumbnails are scaled down to fit in a square of this size
+    THUMBNAIL_SIZE = 640
+
+    def __init__(self, lang=None, memory_budget=64 << 20,
+                 disk_budget=256 << 20, workers=2, converter=None):
+        # thumbnails are rendered on threads of our own
+        gobject.threads_init()
+        cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.expanduser('~/.cache'))
+        self.thumbnail_cache = ThumbnailCache(
+            os.path.join(cache, 'TimeBrowse', 'thumbnails'),
+            memory_budget, disk_budget)
+        self.workers = workers
+        self.threads = []
+        self.queue = Queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.pending = {}      # path -> callbacks waiting for it
+        self.rendering = set()
+        self.requests = 0
         self.pdf = re.compile('.*PDF.*')
-        server = "unoconv --listener"
-        if lang:
-            server = "LANG=%s %s" % (lang, server)
-        os.system(server + " &")
+        if converter == None:
+            converter = DocumentConverter(lang)
+        self.converter = converter
+        self.converter.start()
 
     def create_thumbnail_pixbuf(self, path):
         mime = gio.content_type_guess(path)
+        size = self.THUMBNAIL_SIZE
         if mime == "application/pdf":
-            pdf = path
+            png = self.converter.render(path, size, pdf=True)
         elif mime.startswith("image/"):
-            return gtk.gdk.pixbuf_new_from_file(path)
+            return gtk.gdk.pixbuf_new_from_file_at_size(path, size, size)
         elif mime.startswith("text/"):
-            pdf = self.topdf(path)
+            png = self.converter.render(path, size)
         elif mime.startswith("application/vnd.oasis.opendocument"):
             #openoffice documents
-            pdf = self.topdf(path)
+            png = self.converter.render(path, size)
         elif mime.startswith("application/vnd.openxmlformats-officedocument"):
             #ooxml documents
-            pdf = self.topdf(path)
+            png = self.converter.render(path, size)
         elif (mime.startswith("application/vnd.ms-powerpoint") or
               mime.startswith("application/vnd.ms-excel") or
               mime.startswith("application/vnd.ms-word") ):
             #MS Office documents (non ooxml formats)
-            pdf = self.topdf(path)
+            png = self.converter.render(path, size)
         else:
-            m = commands.getstatusoutput("file %s" % path)
+            m = commands.getstatusoutput("file %s" % commands.mkarg(path))
             if m[0] != 0 or not re.match(".* text.*", m[1]):
                 print >> sys.stderr, "mime type: %s" % mime
                 print >> sys.stderr, "magic: %s" % m[1]
                 return None
-            pdf = self.topdf(path)
+            png = self.converter.render(path, size)
 
-        pix = None
-        if pdf:
-            ppm = self.pdftoppm(pdf)
-            if pdf != path:
-                os.unlink(pdf)
-            if ppm:
-                pix = gtk.gdk.pixbuf_new_from_file(ppm)
-                os.unlink(ppm)
-
-        return pix
-
-    def __execute_cmd__(self, cmd):
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        ret = commands.getstatusoutput(cmd + " > " + tmp.name)
-        if not ret[0] == 0:
-            os.unlink(tmp.name)
+        if not png:
             return None
-        return tmp.name
-
-    def topdf(self, path):
-        cmd = "unoconv --stdout %s" % path
-        return self.__execute_cmd__(cmd)
-
-    def pdftoppm(self, path, page=1):
-        cmd = "pdftoppm -f %d -l %d %s" % (page, page, path)
-        return self.__execute_cmd__(cmd)
+        loader = gtk.gdk.PixbufLoader('png')
+        try:
+            loader.write(png)
+            loader.close()
+        except glib.GError, (e):
+            sys.stderr.write("bad thumbnail of %s: %s\n" % (path, e))
+            return None
+        return loader.get_pixbuf()
 
     def create_pixbuf(self, path):
         pix = self.create_thumbnail_pixbuf(path)
         if pix != None:
             return pix
+        return self.stock_pixbuf(path)
 
+    def stock_pixbuf(self, path):
         style = gtk.Style()
 
         icon = style.lookup_icon_set(gtk.STOCK_FILE)
@@ -299,10 +1382,121 @@ class PixbufFactory:
                                    None, None)
         return pix
 
+    def __shrink__(self, pix):
+        w = pix.get_width()
+        h = pix.get_height()
+        scale = float(self.THUMBNAIL_SIZE) / max(w, h)
+        if scale >= 1:
+            return pix
+        return pix.scale_simple(max(int(w * scale), 1),
+                                max(int(h * scale), 1),
+                                gtk.gdk.INTERP_BILINEAR)
+
+    def __thumbnail_key__(self, path):
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            return None
+        return (path, stat.st_mtime, stat.st_size)
+
+    def __render__(self, path):
+        """
+        Return a pair of the cache key and the thumbnail of @path,
+        which is None when a stock icon has to be used instead.  This
+        leaves GTK widgets alone and may run on any thread.
+        """
+        key = self.__thumbnail_key__(path)
+        if key != None:
+            pix = self.thumbnail_cache.get(key)
+            if pix != None:
+                return (key, pix)
+        pix = self.create_thumbnail_pixbuf(path)
+        if pix != None:
+            pix = self.__shrink__(pix)
+            if key != None:
+                self.thumbnail_cache.put(key, pix)
+        return (key, pix)
+
+    def __stock_fallback__(self, path, key):
+        """
+        Stock icons used when no thumbnail can be made are only kept
+        in memory, so that a later attempt can do better.
+        """
+        pix = self.stock_pixbuf(path)
+        if key != None:
+            self.thumbnail_cache.put(key, pix, persist=False)
+        return pix
+
     def cached_pixbuf(self, path):
-        if not self.thumbnail_cache.has_key(path):
-            self.thumbnail_cache[path] = self.create_pixbuf(path)
-        return self.thumbnail_cache[path]
+        """
+        Return the thumbnail of @path from the cache, creating it when
+        missing.  This blocks until the thumbnail is made; see
+        request_pixbuf() for the way that does not.
+        """
+        (key, pix) = self.__render__(path)
+        if pix == None:
+            pix = self.__stock_fallback__(path, key)
+        return pix
+
+    def request_pixbuf(self, path, callback, prefetch=False):
+        """
+        Have the thumbnail of @path made by a worker thread and pass it
+        to @callback, if any, from the main loop.  A thumbnail held in
+        memory is passed at once.  The latest request is served first,
+        and @prefetch requests only when no other is waiting.
+        """
+        key = self.__thumbnail_key__(path)
+        if key != None:
+            pix = self.thumbnail_cache.get(key, disk=False)
+            if pix != None:
+                if callback:
+                    callback(pix)
+                return
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            callbacks = self.pending.setdefault(path, [])
+            if callback:
+                callbacks.append(callback)
+            self.queue.put((1 if prefetch else 0, -self.requests, path))
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self.__work__)
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+        finally:
+            self.lock.release()
+
+    def __work__(self):
+        while True:
+            (prio, seq, path) = self.queue.get()
+            self.lock.acquire()
+            try:
+                if not self.pending.has_key(path) or path in self.rendering:
+                    continue   # done already or being done
+                self.rendering.add(path)
+            finally:
+                self.lock.release()
+            try:
+                (key, pix) = self.__render__(path)
+            except Exception, (e):
+                sys.stderr.write("can not make thumbnail of %s: %s\n" %
+                                 (path, e))
+                (key, pix) = (None, None)
+            glib.idle_add(self.__deliver__, path, key, pix)
+
+    def __deliver__(self, path, key, pix):
+        self.lock.acquire()
+        try:
+            callbacks = self.pending.pop(path, [])
+            self.rendering.discard(path)
+        finally:
+            self.lock.release()
+        if pix == None:
+            pix = self.__stock_fallback__(path, key)
+        for callback in callbacks:
+            callback(pix)
+        return False
 
     def icon_pixbuf(self, path):
         pix = self.create_pixbuf(path)
@@ -311,6 +1505,213 @@ class PixbufFactory:
         return pix.scale_simple(int(w), int(h), gtk.gdk.INTERP_BILINEAR)
 
 
+class FileDiff:
+    """
+    Differences between a file in a snapshot and its current version.
+    The files are mapped into memory and compared block by block to
+    find the regions that changed, and only those regions are turned
+    into a unified line diff.  Binary files get a summary of the
+    changed regions.  Finished diffs are cached by the snapshot path
+    and the mtime and size of the current file.
+    """
+    BLOCK = 1 << 16
+    # regions larger than this on either side are only summarized
+    MAX_REGION = 4 << 20
+
+    def __init__(self, max_cached=32):
+        self.cache = collections.OrderedDict()
+        self.max_cached = max_cached
+
+    def __map__(self, f):
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def __regions__(self, a, b):
+        """
+        Yield the changed regions of @a and @b as tuples (a_start,
+        a_end, b_start, b_end).  Files of the same size are compared
+        block against block; otherwise the common leading and trailing
+        blocks are stripped and the rest is one region.  None is
+        yielded now and then to let the caller go on with other work.
+        """
+        BLOCK = self.BLOCK
+        la = len(a)
+        lb = len(b)
+        if la == lb:
+            start = None
+            for (n, off) in enumerate(xrange(0, la, BLOCK)):
+                if a[off:off + BLOCK] != b[off:off + BLOCK]:
+                    if start == None:
+                        start = off
+                elif start != None:
+                    yield (start, off, start, off)
+                    start = None
+                if (n & 0xF) == 0xF:
+                    yield None
+            if start != None:
+                yield (start, la, start, la)
+            return
+
+        short = min(la, lb)
+        head = 0
+        while (head + BLOCK <= short and
+               a[head:head + BLOCK] == b[head:head + BLOCK]):
+            head += BLOCK
+            if (head / BLOCK & 0xF) == 0:
+                yield None
+        tail = 0
+        while (head + tail + BLOCK <= short and
+               a[la - tail - BLOCK:la - tail] == b[lb - tail - BLOCK:lb - tail]):
+            tail += BLOCK
+            if (tail / BLOCK & 0xF) == 0:
+                yield None
+        yield (head, la - tail, head, lb - tail)
+
+    def __to_lines__(self, m, start, end, context=3):
+        """
+        Widen [@start, @end) of @m to whole lines, plus @context lines
+        on either side so that every hunk has its context.
+        """
+        start = m.rfind('\n', 0, start) + 1
+        for i in range(context):
+            if start == 0:
+                break
+            start = m.rfind('\n', 0, start - 1) + 1
+        if end > 0 and m[end - 1] != '\n':
+            context += 1
+        for i in range(context):
+            n = m.find('\n', end)
+            if n < 0:
+                end = len(m)
+                break
+            end = n + 1
+        return (start, end)
+
+    def __line_regions__(self, a, b):
+        """
+        Yield changed regions widened to whole lines, merged where
+        they touch, along with the line number each starts at.
+        """
+        pending = None
+        line = [0, 0, 1, 1]   # positions counted up to and line numbers
+        for r in self.__regions__(a, b):
+            if r == None:
+                yield None
+                continue
+            (a0, a1) = self.__to_lines__(a, r[0], r[1])
+            (b0, b1) = self.__to_lines__(b, r[2], r[3])
+            if pending and a0 <= pending[1] and b0 <= pending[3]:
+                pending = (pending[0], max(a1, pending[1]),
+                           pending[2], max(b1, pending[3]))
+                continue
+            if pending:
+                yield self.__number__(a, b, pending, line)
+            pending = (a0, a1, b0, b1)
+        if pending:
+            yield self.__number__(a, b, pending, line)
+
+    def __number__(self, a, b, region, line):
+        for (i, m, pos) in ((0, a, region[0]), (1, b, region[2])):
+            off = line[i]
+            while off < pos:
+                n = min(pos, off + self.BLOCK)
+                line[2 + i] += m[off:n].count('\n')
+                off = n
+            line[i] = pos
+        return region + (line[2], line[3])
+
+    def __hunks__(self, a, b, region):
+        "Format the line diff of one region"
+        (a0, a1, b0, b1, la, lb) = region
+        if a1 - a0 > self.MAX_REGION or b1 - b0 > self.MAX_REGION:
+            yield "@@ -%d +%d @@ %d bytes changed to %d bytes, too large to show\n" % (
+                la, lb, a1 - a0, b1 - b0)
+            return
+        old = a[a0:a1].splitlines(True)
+        new = b[b0:b1].splitlines(True)
+        matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+        for group in matcher.get_grouped_opcodes(3):
+            i1 = group[0][1]
+            i2 = group[-1][2]
+            j1 = group[0][3]
+            j2 = group[-1][4]
+            yield "@@ -%d,%d +%d,%d @@\n" % (la + i1, i2 - i1, lb + j1, j2 - j1)
+            for (tag, i1, i2, j1, j2) in group:
+                if tag == 'equal':
+                    for l in old[i1:i2]:
+                        yield self.__diff_line__(' ', l)
+                    continue
+                if tag in ('replace', 'delete'):
+                    for l in old[i1:i2]:
+                        yield self.__diff_line__('-', l)
+                if tag in ('replace', 'insert'):
+                    for l in new[j1:j2]:
+                        yield self.__diff_line__('+', l)
+            yield None
+
+    def __diff_line__(self, mark, l):
+        if l.endswith('\n'):
+            return mark + l
+        return mark + l + '\n\\ No newline at end of file\n'
+
+    def __is_text__(self, m):
+        return '\0' not in m[:8192]
+
+    def __compute__(self, old, new, cancel):
+        fa = open(old, 'rb')
+        fb = open(new, 'rb')
+        try:
+            a = self.__map__(fa)
+            b = self.__map__(fb)
+            yield "--- %s\n+++ %s\n" % (old, new)
+            text = self.__is_text__(a) and self.__is_text__(b)
+            for r in (self.__line_regions__(a, b) if text else
+                      self.__regions__(a, b)):
+                if cancel != None and cancel.isSet():
+                    return
+                if r == None:
+                    yield None
+                elif text:
+                    for l in self.__hunks__(a, b, r):
+                        if l == None and cancel != None and cancel.isSet():
+                            return
+                        yield l
+                else:
+                    yield "binary: bytes %d-%d changed to bytes %d-%d\n" % r
+        finally:
+            fa.close()
+            fb.close()
+
+    def diff(self, old, new, cancel=None):
+        """
+        Yield the lines of the diff from the file @old to @new.  None is
+        yielded in between so that the caller can go back to the main
+        loop, and the work stops once the event @cancel is set.
+        """
+        st = os.stat(new)
+        key = (old, new, st.st_mtime, st.st_size)
+        if self.cache.has_key(key):
+            lines = self.cache.pop(key)
+            self.cache[key] = lines
+            for l in lines:
+                yield l
+            return
+        lines = []
+        for l in self.__compute__(old, new, cancel):
+            if l != None:
+                lines.append(l)
+            yield l
+        if cancel != None and cancel.isSet():
+            return
+        if len(lines) == 1:
+            lines.append("no changes\n")
+            yield lines[-1]
+        self.cache[key] = lines
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
 def get_selected_path(treeview):
     select = treeview.get_selection()
     rows = select.get_selected_rows()
@@ -384,6 +1785,42 @@ def restore_to(source, dest, confirm_dialog_factory):
         line = "rsync -ax --delete --inplace '%s' '%s'" % (source, target)
         result = commands.getstatusoutput(line)
 
+def show_diff(differ, source, dest):
+    "Open a window showing how @dest changed since the snapshot @source"
+    window = gtk.Window()
+    window.set_title("Changes since %s" %
+                     time.strftime("%x %X",
+                                   time.localtime(os.lstat(source).st_mtime)))
+    window.set_default_size(640, 480)
+    view = gtk.TextView()
+    view.set_editable(False)
+    view.modify_font(pango.FontDescription("monospace"))
+    buf = view.get_buffer()
+    scroll = gtk.ScrolledWindow()
+    scroll.add(view)
+    window.add(scroll)
+
+    cancel = threading.Event()
+    window.connect("destroy", lambda w: cancel.set())
+
+    def add_lines(gen):
+        if cancel.isSet():
+            return
+        try:
+            for i in range(256):
+                l = gen.next()
+                if l == None:
+                    break
+                buf.insert(buf.get_end_iter(), l)
+            glib.idle_add(add_lines, gen)
+        except StopIteration:
+            pass
+        except (IOError, OSError, mmap.error), (e):
+            buf.insert(buf.get_end_iter(), "can not compare: %s\n" % e)
+
+    glib.idle_add(add_lines, differ.diff(source, dest, cancel))
+    window.show_all()
+
 class FlexibleImage(gtk.DrawingArea):
     def __init__(self):
         gtk.DrawingArea.__init__(self)
@@ -422,8 +1859,26 @@ class FlexibleImage(gtk.DrawingArea):
                 destw = 1
         return self.pixbuf.scale_simple(destw, desth, gtk.gdk.INTERP_BILINEAR)
 
-def create_list_gui(current, icon_factory):
-    nilfs = NILFSMounts()
+def create_list_gui(current, icon_factory, differ):
+    # look into every snapshot instead of bisecting when asked to
+    exhaustive = 'TIMEBROWSE_EXHAUSTIVE' in os.environ
+    try:
+        workers = int(os.environ.get('TIMEBROWSE_WORKERS', 4))
+    except ValueError:
+        workers = 4
+    # hide versions whose content did not change
+    dedup = 'TIMEBROWSE_DEDUP' in os.environ
+    try:
+        hash_limit = int(os.environ.get('TIMEBROWSE_HASH_LIMIT', 16 << 20))
+    except ValueError:
+        hash_limit = 16 << 20
+    # how many levels below a directory count as changes to it
+    try:
+        dir_depth = int(os.environ.get('TIMEBROWSE_DIR_DEPTH', 1))
+    except ValueError:
+        dir_depth = 1
+    nilfs = NILFSMounts(exhaustive, workers, get_version_index(),
+                        dedup, hash_limit, dir_depth)
 
     store = gtk.ListStore(gobject.TYPE_STRING,
                           gobject.TYPE_INT64,
@@ -487,16 +1942,35 @@ def create_list_gui(current, icon_factory):
     bbox.pack_end(restore_to_btn, False, False, 10);
     open_in_dir_btn = gtk.Button("Open in Directory")
     bbox.pack_end(open_in_dir_btn, False, False, 10);
+    diff_btn = gtk.Button("Diff Against Current")
+    diff_btn.set_sensitive(os.path.isfile(current))
+    bbox.pack_end(diff_btn, False, False, 10);
     hbox.pack_end(bbox, False, False, 10);
 
     image = FlexibleImage()
     image.w = image.h = 0
     hbox.pack_start(image, True, True, 0);
 
+    shown = [None]
+    def show_thumbnail(path):
+        # a stock icon stands in until the thumbnail is ready
+        shown[0] = path
+        image.set_from_pixbuf(icon_factory.stock_pixbuf(path))
+        def thumbnail_ready(pix):
+            if not condition.isSet() and shown[0] == path:
+                image.set_from_pixbuf(pix)
+        icon_factory.request_pixbuf(path, thumbnail_ready)
+
     def row_selected(treeview, user):
         path = get_selected_path(treeview)
-        if path != False:
-            image.set_from_pixbuf(icon_factory.cached_pixbuf(path))
+        if path == False:
+            return
+        show_thumbnail(path)
+        # get the rows next to the selection ready as well
+        row = treeview.get_selection().get_selected_rows()[1][0][0]
+        for i in (row + 1, row - 1, row + 2):
+            if 0 <= i < len(store):
+                icon_factory.request_pixbuf(store[i][0], None, prefetch=True)
     tree.connect("cursor-changed", row_selected, None)
 
     def copy_to_desktop_button_clicked(widget, info):
@@ -520,6 +1994,13 @@ def create_list_gui(current, icon_factory):
         open_with(os.path.dirname(source))
     open_in_dir_btn.connect("clicked", open_in_dir_button_clicked, tree)
 
+    def diff_button_clicked(widget, info):
+        source = get_selected_path(info)
+        if not source or not os.path.isfile(source):
+            return
+        show_diff(differ, source, current)
+    diff_btn.connect("clicked", diff_button_clicked, tree)
+
     condition = threading.Event()
     def add_list_entry(e):
         store.append([e['path'], e['mtime'],
@@ -532,6 +2013,10 @@ def create_list_gui(current, icon_factory):
             return
         try:
             e = gen.next() 
+            if isinstance(e, Pending):
+                # resumed once the thread it waits for is done
+                e.then(lambda: add_history(gen))
+                return
             if e != None:
                 add_list_entry(e)
             glib.idle_add(add_history, gen)
@@ -543,13 +2028,13 @@ def create_list_gui(current, icon_factory):
         if condition.isSet():
             return
         try:
-            if gen == None:
-                raise StopIteration()
             e = gen.next()
-            if e == None:
+            if isinstance(e, Pending):
+                e.then(lambda: add_first_history(gen))
+            elif e == None:
                 glib.idle_add(add_first_history, gen)
             else:
-                image.set_from_pixbuf(icon_factory.cached_pixbuf(e['path']))
+                show_thumbnail(e['path'])
                 add_list_entry(e)
 
                 vbox.remove(searching_history_label)
@@ -567,7 +2052,7 @@ def create_list_gui(current, icon_factory):
                 vbox.pack_start(gtk.Label("no history")) 
                 vbox.show_all()  
 
-    g = nilfs.get_history(current)
+    g = nilfs.get_history(current, condition)
     glib.idle_add(add_first_history, g)
 
     def stop_generator(w, u):
@@ -579,6 +2064,7 @@ def create_list_gui(current, icon_factory):
 class NILFS2PropertyPage(nautilus.PropertyPageProvider):
     def __init__(self):
         self.factory = PixbufFactory()
+        self.differ = FileDiff()
 
     def get_property_pages(self, files):
         if len(files) != 1:
@@ -593,7 +2079,7 @@ class NILFS2PropertyPage(nautilus.PropertyPageProvider):
         self.property_label = gtk.Label("History")
         self.property_label.show()
 
-        self.vbox = create_list_gui(target, self.factory)
+        self.vbox = create_list_gui(target, self.factory, self.differ)
         self.vbox.show_all()
 
         return nautilus.PropertyPage("NautilusPython::nilfs2",
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+History scanning benchmark for TimeBrowse.
+
+Builds a tree of synthetic "snapshot" directories, each holding a copy
+of one file whose mtime changes in a given number of them, and times
+NILFSMounts.list_history over it in the requested modes, the last
+time with a version index that has seen every snapshot.  With --wide,
+get_dir_info is timed over snapshots of one wide directory.  Runs outside
+of nautilus; the GUI modules are replaced by empty ones when missing.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+def load_timebrowse():
+    for name in ('gtk', 'nautilus', 'gobject', 'glib', 'gio', 'pango'):
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
+    sys.modules['nautilus'].__dict__.setdefault('PropertyPageProvider', object)
+    sys.modules['gtk'].__dict__.setdefault('DrawingArea', object)
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(here, '..', 'nilfs2_ss_manager'))
+    sys.path.insert(0, here)
+    import TimeBrowse
+    return TimeBrowse
+
+def build_tree(root, snapshots, versions, size):
+    """
+    Create @snapshots directories under @root and return cpinfo tuples
+    for them as the mount table would.
+    """
+    changes = set(random.sample(xrange(1, snapshots), versions - 1))
+    mtime = 1300000000
+    cps = []
+    for i in xrange(snapshots):
+        if i in changes:
+            mtime += 60
+        d = os.path.join(root, 'ss-%06d' % i)
+        os.mkdir(d)
+        f = os.path.join(d, 'file')
+        open(f, 'w').write('x' * size)
+        os.utime(f, (mtime, mtime))
+        cps.append((d, i + 1))
+    return cps
+
+def build_wide(root, snapshots, versions, entries):
+    """
+    Create @versions directories of @entries files each and return
+    @snapshots paths to them, in order.  A snapshot of an unchanged
+    directory shows the very same inode, so the snapshots here are
+    symlinks to the shared versions.
+    """
+    dirs = []
+    for v in xrange(versions):
+        d = os.path.join(root, 'wide-%d' % v)
+        os.mkdir(d)
+        for i in xrange(entries):
+            open(os.path.join(d, 'f%06d' % i), 'w').close()
+        dirs.append(d)
+    paths = []
+    for i in xrange(snapshots):
+        p = os.path.join(root, 'wide-ss-%06d' % i)
+        os.symlink(dirs[i * versions / snapshots], p)
+        paths.append(p)
+    return paths
+
+def listdir_lstat(directory):
+    "get_dir_info() as it was before it kept listings"
+    stat = os.stat(directory)
+    newest = stat.st_mtime
+    for e in os.listdir(directory):
+        mtime = os.lstat("%s/%s" % (directory, e)).st_mtime
+        if newest < mtime:
+            newest = mtime
+    return (newest, stat.st_size)
+
+def time_dirs(func, paths):
+    start = time.time()
+    for p in paths:
+        func(p)
+    return time.time() - start
+
+def slow_stat(delay):
+    "Pretend every stat has to go to disk"
+    def wrap(func):
+        def slow(*args):
+            time.sleep(delay)
+            return func(*args)
+        return slow
+    os.stat = wrap(os.stat)
+    os.lstat = wrap(os.lstat)
+
+def drop_caches():
+    os.system('sync')
+    try:
+        open('/proc/sys/vm/drop_caches', 'w').write('3\n')
+    except IOError:
+        sys.stderr.write("can not drop caches; results are warm\n")
+
+def run(tb, cps, exhaustive, workers, cold, index=None):
+    if cold:
+        drop_caches()
+    nilfs = tb.NILFSMounts(exhaustive, workers, index)
+    start = time.time()
+    found = [e for e in nilfs.list_history(cps, 'file', dev='bench') if e]
+    return (time.time() - start, len(found))
+
+def main():
+    parser = argparse.ArgumentParser(description="TimeBrowse history benchmark")
+    parser.add_argument('-n', '--snapshots', type=int, default=2000)
+    parser.add_argument('-k', '--versions', type=int, default=20)
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('--delay', type=float, default=0,
+                        help="seconds added to each stat call")
+    parser.add_argument('--cold', action='store_true',
+                        help="drop the page cache before each run (root)")
+    parser.add_argument('--dir', help="where to build the tree")
+    parser.add_argument('--wide', type=int, metavar='ENTRIES',
+                        help="time get_dir_info over snapshots of a "
+                        "directory with ENTRIES files instead")
+    args = parser.parse_args()
+
+    tb = load_timebrowse()
+    root = tempfile.mkdtemp(prefix='timebrowse-bench-', dir=args.dir)
+    try:
+        if args.wide:
+            paths = build_wide(root, args.snapshots, args.versions,
+                               args.wide)
+            nilfs = tb.NILFSMounts()
+            print "%d snapshots of %d entries, %d versions" % (
+                args.snapshots, args.wide, args.versions)
+            print "listdir + lstat  %8.3fs" % time_dirs(listdir_lstat, paths)
+            t = time_dirs(lambda p: nilfs.get_dir_info(p, 1), paths)
+            print "depth 1          %8.3fs" % t
+            # the own mtime only, which misses files written in place
+            t = time_dirs(lambda p: nilfs.get_dir_info(p, 0), paths)
+            print "depth 0 (dir only)%7.3fs" % t
+            return
+        cps = build_tree(root, args.snapshots, args.versions, 64)
+        if args.delay:
+            slow_stat(args.delay)
+        print "%d snapshots, %d versions" % (args.snapshots, args.versions)
+        for w in args.workers:
+            t, found = run(tb, cps, True, w, args.cold)
+            print "exhaustive  workers %-3d %8.3fs %d found" % (w, t, found)
+        t, found = run(tb, cps, False, 1, args.cold)
+        print "bisect                  %8.3fs %d found" % (t, found)
+        index = tb.VersionIndex(os.path.join(root, 'versions.db'))
+        run(tb, cps, True, 1, False, index)
+        t, found = run(tb, cps, True, 1, args.cold, index)
+        print "exhaustive, indexed     %8.3fs %d found" % (t, found)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Microbenchmark of the checkpoint cache refresh of passive mode.
+
+Builds a cache of the requested numbers of checkpoints, a tenth of
+them snapshots, and a fresh lscp list in which the cleaner removed
+the older half of the plain checkpoints, some checkpoints became
+snapshots by hand and a hundred checkpoints were created, and times
+NILFSSSManager.__refresh_cp_cache__ on them.  The quadratic former
+implementation from test_cp_cache is timed as well up to --old-limit
+checkpoints.
+"""
+
+import argparse
+import random
+import time
+
+import nilfs2
+from bench_manager import load_daemon
+from test_cp_cache import OldCache, make_manager, summary
+
+def make_lists(n):
+    rand = random.Random(n)
+    cps = [nilfs2.Checkpoint(cno, 1300000000 + cno, rand.random() < 0.1)
+           for cno in xrange(1, n + 1)]
+    fresh = []
+    for cp in cps:
+        if not cp.ss and cp.cno < n / 2:
+            continue
+        fresh.append(nilfs2.Checkpoint(cp.cno, cp.date,
+                                       cp.ss or rand.random() < 0.01))
+    fresh.extend(nilfs2.Checkpoint(cno, 1300000000 + cno, False)
+                 for cno in xrange(n + 1, n + 101))
+    return cps, fresh
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="checkpoint cache refresh "
+                                     "microbenchmark")
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[100000, 1000000],
+                        help="numbers of cached checkpoints (default 100k "
+                        "and 1M)")
+    parser.add_argument('--old-limit', type=int, default=100000,
+                        help="largest cache to time the former "
+                        "implementation on")
+    args = parser.parse_args()
+
+    dm = load_daemon(time)
+    manager = make_manager(dm)
+    for n in args.sizes:
+        cps, fresh = make_lists(n)
+        manager.cps = cps
+        new = timed(manager.__refresh_cp_cache__, list(fresh))
+        line = "%8d checkpoints: %.3fs" % (n, new)
+        if n <= args.old_limit:
+            cps, fresh = make_lists(n)
+            old = OldCache(cps)
+            line += ", former %.3fs" % timed(old.__refresh_cp_cache__, fresh)
+            if summary(old.cps) != summary(manager.cps):
+                line += " (results differ)"
+        print line
+
+if __name__ == '__main__':
+    main()
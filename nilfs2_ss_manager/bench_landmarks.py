@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Benchmark of the landmark computation.
+
+Builds a history of the requested numbers of snapshots spread evenly
+over a year and a half, and times the full scan the manager used to
+run on every tick, old_landmarks() from test_landmarks, and the same
+scan over array('l') columns of checkpoint numbers and dates, against
+NILFSSSManager.__find_landmarks__ on its first call and on the
+following ticks, each of which adds --rate checkpoints per second of
+--period.  The targets of every call are thinned out before the next
+one, as the manager does.  The first call is checked to choose the
+same snapshots as the full scan.
+"""
+
+import argparse
+import array
+import itertools
+import time
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+from test_landmarks import FakeNILFS2, old_landmarks
+
+DAY = 24 * 60 * 60
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def column_landmarks(cnos, dates, now, interval, threshold,
+                     protection_period, protection_max):
+    """
+    old_landmarks() over columns of the numbers and dates of the
+    snapshots, returning the numbers of the landmarks and targets.
+    """
+    old_list = [cno for cno, date in itertools.izip(cnos, dates)
+                if (now - date) > protection_max]
+    window = [i for i, date in enumerate(dates)
+              if protection_period < (now - date) < protection_max]
+    if not window:
+        return [], old_list
+
+    landmarks = []
+    targets = []
+    prev = window[0]
+    group_start = dates[prev]
+    for i in itertools.islice(window, 1, None):
+        date = dates[i]
+        if (date - dates[prev]) > interval or (date - group_start) > threshold:
+            landmarks.append(cnos[prev])
+            group_start = date
+        else:
+            targets.append(cnos[prev])
+        prev = i
+    landmarks.append(cnos[prev])
+    return landmarks, old_list + targets
+
+def main():
+    parser = argparse.ArgumentParser(description="landmark computation "
+                                     "benchmark")
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[100000, 1000000],
+                        help="numbers of snapshots (default 100k and 1M)")
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--period', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=1)
+    args = parser.parse_args()
+
+    clock = nilfs2_sim.SimClock()
+    dm = load_daemon(clock)
+    params = {'interval': 60, 'threshold': 600,
+              'protection_period': 3600, 'protection_max': 365 * DAY}
+    for n in args.sizes:
+        span = 547 * DAY
+        start = clock.now - span
+        cps = [nilfs2.Checkpoint(i + 1, start + i * span / n, True)
+               for i in xrange(n)]
+        ns = FakeNILFS2(cps)
+        manager = dm.NILFSSSManager(ns, '/', dm.Logger(), **params)
+        full, old = timed(old_landmarks, cps, clock.now, **params)
+        cnos = array.array('l', (cp.cno for cp in cps))
+        dates = array.array('l', (cp.date for cp in cps))
+        columns, found = timed(column_landmarks, cnos, dates, clock.now,
+                               **params)
+        if found[1] != [cp.cno for cp in old[1]]:
+            print "%d snapshots: column results differ" % n
+        first, new = timed(manager.__find_landmarks__)
+        if (sorted(cp.cno for cp in old[1]) != [cp.cno for cp in new[1]]):
+            print "%d snapshots: results differ" % n
+        manager.chcp_many(new[1])
+        ticks = []
+        for i in xrange(args.ticks):
+            clock.now += args.period
+            cno = cps[-1].cno
+            for j in xrange(int(args.period * args.rate)):
+                cps.append(nilfs2.Checkpoint(cno + j + 1, clock.now, True))
+            manager.cps = cps
+            t, found = timed(manager.__find_landmarks__)
+            manager.chcp_many(found[1])
+            ticks.append(t)
+        ticks.sort()
+        print ("%8d snapshots: full scan %.3fs, columns %.3fs, first call %.3fs, "
+               "tick %.2fms (median), %.2fms (max)" %
+               (n, full, columns, first, ticks[len(ticks) // 2] * 1000,
+                ticks[-1] * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Benchmark of the lscp parser.
+
+Writes synthetic lscp output of the requested numbers of rows, with
+two checkpoints a second and a snapshot now and then, and parses it
+with NILFS2.lscp() and with the former parser, which ran a regex over
+the whole output and built a dictionary with a struct_time for every
+checkpoint.  Both read the same file rather than a pipe from lscp.
+Every run is done in a child process of its own and reports its wall
+time and the peak memory of the process; the results of both parsers
+are checked to be the same.
+"""
+
+import argparse
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import isolated
+
+class OldParser:
+    "lscp parser of nilfs2.NILFS2 before the output was streamed"
+    cpinfo_regex = re.compile(
+        r'^ +([1-9]|[1-9][0-9]+) +([^ ]+ [^ ]+) +(ss|cp) +([^ ]+) +.*$',
+        re.M)
+
+    def parse(self, output):
+        a = self.cpinfo_regex.findall(output)
+
+        a = [ {'cno'  : int(e[0]),
+               'date' : time.strptime(e[1], "%Y-%m-%d %H:%M:%S"),
+               'ss'  : e[2] == 'ss'}
+               for e in a if e[3] != 'i' ]
+
+        if not a:
+            return []
+
+        prev = a.pop(0)
+        if not a:
+            return [prev]
+
+        ss = prev if prev['ss'] else None
+        l = []
+        for e in a:
+            if e['date'] != prev['date']:
+                l.append(ss if ss else prev)
+                ss = None
+            prev = e
+            if prev['ss']:
+                ss = prev
+        l.append(ss if ss else a[-1])
+        return l
+
+class FileBackend(nilfs2.CLIBackend):
+    "CLI backend reading lscp output from a file"
+    def __init__(self, path):
+        nilfs2.CLIBackend.__init__(self, '/dev/bench')
+        self.path = path
+
+    def cpinfo(self, index):
+        with open(self.path) as f:
+            for cp in self.__parse_lscp_lines__(f, []):
+                yield cp
+
+def write_output(path, rows):
+    "Write lscp output of @rows checkpoints to @path"
+    random.seed(rows)
+    volume = nilfs2_sim.SimVolume(nilfs2_sim.SimClock(), gc_age=1 << 40)
+    volume.advance(rows / 2, 2)
+    for cp in volume.iter_from(1):
+        cp.ss = random.random() < 0.05
+    backend = nilfs2_sim.SimBackend(volume)
+    with open(path, 'w') as f:
+        for line in backend.lscp_output(1):
+            f.write(line + '\n')
+
+def parse_old(path):
+    start = time.time()
+    with open(path) as f:
+        cps = OldParser().parse(f.read())
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, rss, [(cp['cno'], int(time.mktime(cp['date'])), cp['ss'])
+                          for cp in cps]
+
+def parse_new(path):
+    start = time.time()
+    cps = nilfs2.NILFS2('/dev/bench', FileBackend(path)).lscp()
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, rss, [(cp.cno, cp.date, cp.ss) for cp in cps]
+
+def main():
+    parser = argparse.ArgumentParser(description="lscp parser benchmark")
+    parser.add_argument('rows', nargs='*', type=int,
+                        default=[10000, 100000, 1000000],
+                        help="numbers of checkpoints (default 10k, 100k "
+                        "and 1M)")
+    parser.add_argument('--dir', help="where to write the output")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='nilfs2-bench-', dir=args.dir)
+    try:
+        print "%8s  %18s  %18s" % ("rows", "old wall / RSS", "new wall / RSS")
+        for rows in args.rows:
+            path = os.path.join(root, 'lscp-%d' % rows)
+            write_output(path, rows)
+            old = isolated(parse_old, path)
+            new = isolated(parse_new, path)
+            if old[2] != new[2]:
+                sys.exit("results differ for %d rows" % rows)
+            print "%8d  %8.2fs / %4dMiB  %8.2fs / %4dMiB" % (
+                rows, old[0], old[1] / 1024, new[0], new[1] / 1024)
+            sys.stdout.flush()
+            os.unlink(path)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
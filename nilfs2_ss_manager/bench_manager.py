@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+End-to-end benchmark of the snapshot manager on a simulated volume.
+
+Each scenario runs NILFSSSManager from the daemon script against
+nilfs2_sim on a simulated clock, with snapshot mount points made in a
+temporary directory, and reports the latency of its ticks, the number
+of commands it would have run and the peak memory of the process.
+The time the simulated commands take to print and parse their output
+is part of the ticks, as it would be with the real commands.
+Every scenario runs in a child process of its own.  Runs as a plain
+user; the modules the daemon needs only for its main loop are
+replaced by empty ones when missing.
+
+Scenarios:
+  year     a year of checkpoints at --rate per second thinned out to
+           a snapshot every --landmark-threshold seconds, followed by
+           --days of them with the manager running
+  burst    --days of checkpoints, then --downtime seconds of them
+           created while the daemon is stopped, and a restart
+  passive  passive mode for --ticks, with snapshots made and deleted
+           by hand
+"""
+
+import argparse
+import cPickle
+import os
+import resource
+import shutil
+import sys
+import syslog
+import tempfile
+import time
+import traceback
+import types
+
+import nilfs2
+import nilfs2_sim
+
+DAY = 24 * 60 * 60
+
+def load_daemon(clock):
+    """
+    Load the daemon script, leaving out its main program, with @clock
+    as its time module.
+    """
+    for name in ('yaml', 'gobject', 'daemon', 'daemon.pidlockfile'):
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
+    sys.modules['daemon'].__dict__.setdefault(
+        'pidlockfile', sys.modules['daemon.pidlockfile'])
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'nilfs2_ss_manager')
+    source = open(path).read()
+    dm = types.ModuleType('nilfs2_ss_manager')
+    exec compile(source[:source.index('\ntry:\n')], path, 'exec') in dm.__dict__
+    dm.time = clock
+    return dm
+
+class Bench:
+    "Simulated volume and snapshot manager in a temporary directory"
+    def __init__(self, args, root):
+        self.args = args
+        self.root = root
+        self.clock = nilfs2_sim.SimClock()
+        self.dm = load_daemon(self.clock)
+        self.volume = nilfs2_sim.SimVolume(self.clock, args.gc_age,
+                                           args.latency)
+        self.mounts = nilfs2_sim.SimMounts(self.volume)
+        self.logger = self.dm.Logger(
+            priomask=syslog.LOG_UPTO(syslog.LOG_WARNING))
+        self.ticks = []
+        self.unmounter = self.dm.UnmountPool(args.unmount_workers,
+                                             self.logger)
+
+    def manager(self, passive=False, cache=False):
+        "Start a snapshot manager on the volume and mount its snapshots"
+        mp = os.path.join(self.root, 'mnt')
+        if not os.path.isdir(mp):
+            os.mkdir(mp)
+        ns = nilfs2.NILFS2(self.volume.device,
+                           nilfs2_sim.SimBackend(self.volume,
+                                                 not self.args.no_cpstat))
+        cache = (self.dm.CheckpointCache(os.path.join(self.root, 'cache'),
+                                         self.volume.device)
+                 if cache else None)
+        retention = None
+        if self.args.retention or self.args.max_snapshots:
+            retention = self.dm.RetentionPolicy(self.args.retention,
+                                                self.args.max_snapshots)
+        start = time.time()
+        manager = self.dm.NILFSSSManager(
+            ns, mp, self.logger, passive=passive, cache=cache,
+            interval=self.args.landmark_interval,
+            threshold=self.args.landmark_threshold,
+            protection_period=self.args.protection_period,
+            protection_max=self.args.protection_max, retention=retention)
+        self.mounts.attach(manager)
+        manager.unmounter = self.unmounter
+        manager.mount_ss()
+        return manager, time.time() - start
+
+    def run(self, manager, seconds, rate, each=None):
+        """
+        Let the volume live @seconds at @rate checkpoints per second
+        and update @manager every period, calling @each before.
+        """
+        period = self.args.period
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.volume.advance(period, rate)
+            if each:
+                each()
+            start = time.time()
+            manager.update()
+            self.ticks.append(time.time() - start)
+
+    def stop(self, manager):
+        "Shut @manager down and return how long it took"
+        start = time.time()
+        manager.shutdown()
+        return time.time() - start
+
+    def report(self, **extra):
+        ticks = sorted(self.ticks) or [0]
+        volume = self.volume
+        result = {'ticks': len(self.ticks),
+                  'mean': sum(ticks) / len(ticks),
+                  'p50': ticks[len(ticks) / 2],
+                  'p99': ticks[len(ticks) * 99 / 100],
+                  'max': ticks[-1],
+                  'commands': dict(volume.calls),
+                  'checkpoints': volume.live,
+                  'snapshots': volume.snapshots,
+                  'mounts': len(self.mounts.mounts),
+                  'maxrss': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss}
+        result.update(extra)
+        return result
+
+def year(bench):
+    args = bench.args
+    bench.volume.history(args.protection_max - DAY, args.rate,
+                         args.landmark_threshold)
+    manager, startup = bench.manager()
+    bench.run(manager, args.days * DAY, args.rate)
+    return bench.report(startup=startup)
+
+def burst(bench):
+    manager, startup = bench.manager(cache=True)
+    bench.run(manager, bench.args.days * DAY, bench.args.rate)
+    shutdown = bench.stop(manager)
+    bench.volume.advance(bench.args.downtime, bench.args.rate)
+    bench.ticks = []
+    bench.volume.calls.clear()
+    manager, restart = bench.manager(cache=True)
+    bench.run(manager, 10 * bench.args.period, bench.args.rate)
+    return bench.report(startup=startup, shutdown=shutdown, restart=restart)
+
+def passive(bench):
+    volume = bench.volume
+    for i in xrange(bench.args.snapshots):
+        volume.advance(bench.args.period, bench.args.rate)
+        volume.checkpoint(True)
+    manager, startup = bench.manager(passive=True)
+    # Make a snapshot every tick, and change one made earlier back
+    # into a checkpoint every ten ticks, as an administrator would.
+    state = {'n': 0}
+    def by_hand():
+        volume.checkpoint(True)
+        state['n'] += 1
+        if state['n'] % 10 == 0:
+            for cp in volume.iter_from(state['n'] * 7):
+                if cp.ss and cp.cno not in volume.mounted:
+                    volume.chcp(cp.cno, False)
+                    break
+    bench.run(manager, bench.args.ticks * bench.args.period, bench.args.rate,
+              by_hand)
+    return bench.report(startup=startup)
+
+scenarios = {'year': year, 'burst': burst, 'passive': passive}
+
+def isolated(func, *args):
+    "Call @func in a child process and return its result"
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            result = func(*args)
+        except BaseException, e:
+            traceback.print_exc()
+            result = e
+            status = 1
+        os.write(w, cPickle.dumps(result, 2))
+        os._exit(status)
+    os.close(w)
+    f = os.fdopen(r, 'rb')
+    data = f.read()
+    f.close()
+    os.waitpid(pid, 0)
+    result = cPickle.loads(data)
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+def run_scenario(name, args):
+    root = tempfile.mkdtemp(prefix='nilfs2-bench-', dir=args.dir)
+    try:
+        return scenarios[name](Bench(args, root))
+    finally:
+        shutil.rmtree(root)
+
+def show(name, r):
+    print "%-8s %d ticks: mean %.2fms p50 %.2fms p99 %.2fms max %.2fms" % (
+        name, r['ticks'], r['mean'] * 1000, r['p50'] * 1000,
+        r['p99'] * 1000, r['max'] * 1000)
+    for key in ('startup', 'shutdown', 'restart'):
+        if key in r:
+            print "         %s %.3fs" % (key, r[key])
+    print "         commands %d (%s)" % (
+        sum(r['commands'].values()),
+        ", ".join("%s %d" % e for e in sorted(r['commands'].items())))
+    print ("         %d checkpoints, %d snapshots, %d mounted, "
+           "max rss %d MiB" % (r['checkpoints'], r['snapshots'],
+                               r['mounts'], r['maxrss'] / 1024))
+
+def main():
+    parser = argparse.ArgumentParser(description="NILFS snapshot manager "
+                                     "benchmark on a simulated volume")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help="year, burst or passive (default all)")
+    parser.add_argument('--days', type=float, default=1,
+                        help="days the manager runs in the year and "
+                        "burst scenarios")
+    parser.add_argument('--ticks', type=int, default=200,
+                        help="ticks of the passive scenario")
+    parser.add_argument('--rate', type=float, default=1,
+                        help="checkpoints per second")
+    parser.add_argument('--period', type=int, default=5,
+                        help="scan period of the manager (secs)")
+    parser.add_argument('--downtime', type=int, default=6 * 60 * 60,
+                        help="time the daemon is stopped in the burst "
+                        "scenario (secs)")
+    parser.add_argument('--snapshots', type=int, default=1000,
+                        help="snapshots made before the passive scenario")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to each command")
+    parser.add_argument('--gc-age', type=int, default=3600,
+                        help="age of plain checkpoints removed by the "
+                        "cleaner (secs)")
+    parser.add_argument('--unmount-workers', type=int, default=4)
+    parser.add_argument('--no-cpstat', action='store_true',
+                        help="run as if checkpoint counters are missing")
+    parser.add_argument('--landmark-interval', type=int, default=60)
+    parser.add_argument('--landmark-threshold', type=int, default=600)
+    parser.add_argument('--protection-period', type=int, default=3600)
+    parser.add_argument('--protection-max', type=int, default=365 * DAY)
+    parser.add_argument('--retention', nargs='+', metavar='AGE:SPACING',
+                        type=lambda tier: [int(n) for n in tier.split(':')],
+                        help="retention tiers instead of the sparse "
+                        "parameters")
+    parser.add_argument('--max-snapshots', type=int)
+    parser.add_argument('--dir', help="where to make mount points")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error("unknown scenario: %s" % name)
+
+    for name in args.scenarios or ['year', 'burst', 'passive']:
+        show(name, isolated(run_scenario, name, args))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Benchmark of the mount table.
+
+Writes a synthetic mount table with the requested numbers of snapshot
+mounts of one NILFS volume, and times what the daemon and the
+extension used to do on every call, reading the file and running
+their regexes over it, against parsing it into nilfs2.MountTable and
+the lookups on the table, which cost a poll() until the mount table
+changes.  Every method is checked to find the same snapshots.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import nilfs2
+
+class OldScan:
+    "Mount table scans of the daemon and the extension before MountTable"
+    nilfs_entry_regex = re.compile('^ *([^ ]+) +([^ ]+) +nilfs2 +([^ ]+) '
+                                   '+([^ ]+) +([^ ]+) *$', re.M)
+    cp_regex = re.compile('.*cp=.*')
+    nilfs_cp_entry_regex = re.compile('^ *([^ ]+) +([^ ]+) +nilfs2 +([^ ]*'
+                                      'cp=([\d]+)[^ ]*) +([^ ]+) +([^ ]+) *$',
+                                      re.M)
+
+    def __init__(self, path):
+        self.path = path
+
+    def scan_mounts(self, mp):
+        regex = re.compile(
+            '^ *([^ ]+) +(' + mp +
+            '/[^ ]+) +nilfs2 +[^ ]*cp=[\d]+[^ ]* +[^ ]+ +[^ ]+ *$', re.M)
+        with open(self.path) as f:
+            return [m[1] for m in regex.findall(f.read())]
+
+    def find_nilfs_in_mtab(self):
+        with open(self.path) as f:
+            entries = self.nilfs_entry_regex.findall(f.read())
+        actives = [{'dev' : str(e[0]), 'mp' : str(e[1])}
+                    for e in entries if not self.cp_regex.match(e[2])]
+        actives.sort(lambda a, b: -cmp(len(a['mp']), len(b['mp'])))
+        checkpoints = {}
+        with open(self.path) as f:
+            for m in self.nilfs_cp_entry_regex.findall(f.read()):
+                checkpoints.setdefault(m[0], []).append((m[1], int(m[3])))
+        for cps in checkpoints.itervalues():
+            cps.sort(lambda a, b: cmp(a[1], b[1]))
+        for a in actives:
+            if a['dev'] in checkpoints:
+                a['cps'] = checkpoints[a['dev']]
+        return actives
+
+def write_table(path, snapshots):
+    "Write a mount table of @snapshots snapshot mounts to @path"
+    with open(path, 'w') as f:
+        f.write("/dev/sda1 / ext4 rw,relatime 0 0\n"
+                "proc /proc proc rw,nosuid,nodev,noexec 0 0\n"
+                "/dev/sdb1 /home nilfs2 rw,relatime 0 0\n"
+                "none /mnt/ss tmpfs rw,relatime 0 0\n")
+        date = 1300000000
+        for cno in xrange(1, snapshots + 1):
+            f.write("/dev/sdb1 /mnt/ss/%s nilfs2 ro,relatime,cp=%d 0 0\n" %
+                    (time.strftime("%Y.%m.%d-%H.%M.%S",
+                                   time.localtime(date + cno * 60)), cno))
+
+def timed(func, *args):
+    "Return the mean time of calls to @func taking at least 0.2s in all"
+    n = 0
+    start = time.time()
+    while True:
+        result = func(*args)
+        n += 1
+        elapsed = time.time() - start
+        if elapsed > 0.2:
+            return elapsed / n, result
+
+def show(name, seconds):
+    if seconds < 1e-3:
+        print "  %-36s %8.1fus" % (name, seconds * 1e6)
+    else:
+        print "  %-36s %8.2fms" % (name, seconds * 1e3)
+
+def main():
+    parser = argparse.ArgumentParser(description="mount table benchmark")
+    parser.add_argument('sizes', nargs='*', type=int, default=[10000],
+                        help="numbers of snapshot mounts (default 10k)")
+    parser.add_argument('--dir', help="where to write the mount table")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='nilfs2-bench-', dir=args.dir)
+    try:
+        path = os.path.join(root, 'mounts')
+        for n in args.sizes:
+            write_table(path, n)
+            old = OldScan(path)
+            print "%d snapshot mounts" % n
+            t, daemon = timed(old.scan_mounts, '/mnt/ss')
+            show("former daemon scan", t)
+            t, extension = timed(old.find_nilfs_in_mtab)
+            show("former extension scan", t)
+            t, table = timed(nilfs2.MountTable, path)
+            show("MountTable parse", t)
+            t, r = timed(table.refresh)
+            show("refresh of an unchanged table", t)
+            t, cps = timed(table.nilfs_snapshots, '/dev/sdb1')
+            show("snapshots of a device", t)
+            t, e = timed(table.by_mount_point, '/home')
+            show("lookup by mount point", t)
+            t, mps = timed(lambda: [mp for mp, cno in table.nilfs_snapshots()
+                                    if mp.startswith('/mnt/ss/')])
+            show("daemon scan on the table", t)
+            if (sorted(mps) != sorted(daemon) or
+                cps != extension[0]['cps']):
+                print "  results differ"
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
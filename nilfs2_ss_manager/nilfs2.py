@@ -15,72 +15,633 @@ __copyright__ = "Copyright (c) 2011 - Jiro SEKIBA <jir@unicus.jp>"
 __license__   = "LGPL"
 __version__   = "0.6"
 
+import collections
 import commands
+import ctypes
+import errno
+import fcntl
+import json
+import os
 import re
+import select
+import socket
+import struct
+import subprocess
+import syslog
+import threading
 import time
 
-class NILFS2:
-    def __init__(self, device):
-        self.cpinfo_regex = re.compile(
-            r'^ +([1-9]|[1-9][0-9]+) +([^ ]+ [^ ]+) +(ss|cp) +([^ ]+) +.*$',
-            re.M)
+class Checkpoint(object):
+    """
+    Compact checkpoint record.  @date holds the creation time in
+    seconds since the epoch.  Dictionary-style access is kept so that
+    records can be used where checkpoint dictionaries were expected.
+    """
+    __slots__ = ('cno', 'date', 'ss', 'mp')
+
+    def __init__(self, cno, date, ss):
+        self.cno = cno
+        self.date = date
+        self.ss = ss
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    has_key = __contains__
+
+    def __repr__(self):
+        return "Checkpoint(%d, %d, %s)" % (self.cno, self.date, self.ss)
+
+class ChcpException(Exception):
+    """
+    Raised when changing the mode of some checkpoints failed.
+    @failures is a list of (<checkpoint numbers>, <error message>,
+    <errno>) tuples, one for each checkpoint which could not be
+    changed, where the errno is None if it is not known.
+    """
+    def __init__(self, failures):
+        Exception.__init__(self, "; ".join(
+            "%s: %s" % (" ".join(str(cno) for cno in cnos), message)
+            for cnos, message, err in failures))
+        self.failures = failures
+
+class CLIBackend:
+    """
+    Backend which runs the lscp, chcp and mkcp commands of nilfs-utils.
+    The commands are run in the C locale so that their messages can be
+    parsed.  Checkpoint counters are read from the NILFS sysfs
+    directory under @sysfs if the kernel provides it.
+    """
+    # Messages of the errors the callers of chcp tell apart
+    __errors__ = {'No such file or directory': errno.ENOENT,
+                  'Device or resource busy': errno.EBUSY,
+                  'Operation not permitted': errno.EPERM,
+                  'Invalid argument': errno.EINVAL}
+
+    def __init__(self, device, sysfs='/sys/fs/nilfs2'):
         self.device = device
+        self.sysfs = os.path.join(sysfs,
+                                  os.path.basename(os.path.realpath(device)),
+                                  'checkpoints')
+        self.__minute__ = (None, 0)
+        self.__env__ = dict(os.environ, LC_ALL='C')
 
     def __run_cmd__(self, line):
-        result = commands.getstatusoutput(line)
+        result = commands.getstatusoutput('LC_ALL=C ' + line)
         if result[0] != 0:
             raise Exception(result[1])
         return result[1]
 
-    def __parse_lscp_output__(self, output):
-        a = self.cpinfo_regex.findall(output)
-
-        a = [ {'cno'  : int(e[0]),
-               'date' : time.strptime(e[1], "%Y-%m-%d %H:%M:%S"),
-               'ss'  : e[2] == 'ss'}
-               for e in a if e[3] != 'i' ]
-
-        if not a:
-            return []
-
-        # Drop checkpoints that have the same timestamp with its
-        # predecessor.  If a snapshot is present in the series of
-        # coinstantaneous checkpoints, we leave it rather than plain
-        # checkpoints.
-        prev = a.pop(0)
-        if not a:
-            return [prev]
-
-        ss = prev if prev['ss'] else None
-        l = []
-        for e in a:
-            if e['date'] != prev['date']:
-                l.append(ss if ss else prev)
-                ss = None
-            prev = e
-            if prev['ss']:
-                ss = prev
-        l.append(ss if ss else a[-1])
-        return l
+    def __parse_date__(self, day, clock):
+        """
+        Convert local date and time strings printed by lscp into
+        seconds since the epoch.  Consecutive checkpoints mostly fall
+        in the same minute, so the last converted minute is cached.
+        """
+        minute = day + clock[:5]
+        if self.__minute__[0] != minute:
+            t = time.strptime(day + " " + clock[:5], "%Y-%m-%d %H:%M")
+            self.__minute__ = (minute, int(time.mktime(t)))
+        return self.__minute__[1] + int(clock[6:8])
 
-    def lscp(self, index=1):
-        result = self.__run_cmd__("lscp -i %d %s" % (index, self.device))
-        return self.__parse_lscp_output__(result)
+    def __parse_lscp_lines__(self, lines, errors):
+        """
+        Parse lscp output line by line and yield a Checkpoint for
+        every valid entry.  Lines which are not checkpoint entries
+        are appended to @errors.
+        """
+        for line in lines:
+            e = line.split()
+            if (len(e) < 5 or not e[0].isdigit() or
+                e[0][0] == '0' or e[3] not in ('ss', 'cp')):
+                errors.append(line.rstrip())
+                continue
+            if e[4] == 'i':
+                continue
+            yield Checkpoint(int(e[0]), self.__parse_date__(e[1], e[2]),
+                             e[3] == 'ss')
 
-    def chcp(self, cno, ss=False):
+    def cpinfo(self, index):
+        """
+        Run lscp starting from checkpoint number @index and yield
+        checkpoints while reading its output.
+        """
+        p = subprocess.Popen(["lscp", "-i", str(index), self.device],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, env=self.__env__)
+        errors = []
+        try:
+            for cp in self.__parse_lscp_lines__(p.stdout, errors):
+                yield cp
+        finally:
+            p.stdout.close()
+            status = p.wait()
+        if status != 0:
+            raise Exception("\n".join(errors))
+
+    def chcp(self, cno, ss):
         line = "chcp cp "
         if ss:
             line = "chcp ss "
         line += self.device + " %i" % cno
         return self.__run_cmd__(line)
 
-    def mkcp(self, ss=False):
+    def chcp_many(self, cnos, ss, argmax=65536):
+        """
+        Change the mode of the checkpoints @cnos, passing as many
+        checkpoint numbers to each chcp command as fit in @argmax
+        bytes of arguments.
+        """
+        head = ["chcp", "ss" if ss else "cp", self.device]
+        failures = []
+        chunk = []
+        size = 0
+        for cno in cnos:
+            arg = str(cno)
+            if chunk and size + len(arg) + 1 > argmax:
+                self.__chcp_chunk__(head, chunk, failures)
+                chunk = []
+                size = 0
+            chunk.append(arg)
+            size += len(arg) + 1
+        if chunk:
+            self.__chcp_chunk__(head, chunk, failures)
+        if failures:
+            raise ChcpException(failures)
+
+    # chcp changes every checkpoint it can and reports each one it
+    # could not change by a line ending in "<cno>: <error>".
+    __chcp_error__ = re.compile(r'(?:^|[\s:])(\d+): ([^:]+)$')
+
+    def __chcp_run__(self, args):
+        "Run chcp with @args and return its status and output."
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, env=self.__env__)
+        output = p.communicate()[0]
+        return p.returncode, output
+
+    def __chcp_chunk__(self, head, chunk, failures):
+        status, output = self.__chcp_run__(head + chunk)
+        if status == 0:
+            return
+        cnos = set(int(arg) for arg in chunk)
+        found = []
+        for line in output.splitlines():
+            m = self.__chcp_error__.search(line.strip())
+            if m and int(m.group(1)) in cnos:
+                message = m.group(2).strip()
+                found.append(([int(m.group(1))], message,
+                              self.__errors__.get(message)))
+        if found:
+            failures.extend(found)
+        elif len(chunk) > 1:
+            # Find out which ones failed one checkpoint at a time
+            for arg in chunk:
+                self.__chcp_chunk__(head, [arg], failures)
+        else:
+            failures.append(([int(chunk[0])], output.strip(), None))
+
+    def cpstat(self):
+        try:
+            return tuple(int(open(os.path.join(self.sysfs, name)).read())
+                         for name in ('next_checkpoint',
+                                      'checkpoints_number',
+                                      'snapshots_number'))
+        except (IOError, ValueError):
+            return None
+
+    def mkcp(self, ss):
         line = "mkcp"
         if ss:
             line += " -s"
         line += " " + self.device
         return self.__run_cmd__(line)
 
+# Structures and ioctl numbers from linux/nilfs2_api.h
+class nilfs_cpinfo(ctypes.Structure):
+    _fields_ = [('ci_flags', ctypes.c_uint32),
+                ('ci_pad', ctypes.c_uint32),
+                ('ci_cno', ctypes.c_uint64),
+                ('ci_create', ctypes.c_uint64),
+                ('ci_nblk_inc', ctypes.c_uint64),
+                ('ci_inodes_count', ctypes.c_uint64),
+                ('ci_blocks_count', ctypes.c_uint64),
+                ('ci_next', ctypes.c_uint64)]
+
+class nilfs_argv(ctypes.Structure):
+    _fields_ = [('v_base', ctypes.c_uint64),
+                ('v_nmembs', ctypes.c_uint32),
+                ('v_size', ctypes.c_uint16),
+                ('v_flags', ctypes.c_uint16),
+                ('v_index', ctypes.c_uint64)]
+
+class nilfs_cpstat(ctypes.Structure):
+    _fields_ = [('cs_cno', ctypes.c_uint64),
+                ('cs_ncps', ctypes.c_uint64),
+                ('cs_nsss', ctypes.c_uint64)]
+
+class nilfs_cpmode(ctypes.Structure):
+    _fields_ = [('cm_cno', ctypes.c_uint64),
+                ('cm_mode', ctypes.c_uint32),
+                ('cm_pad', ctypes.c_uint32)]
+
+def __ioc__(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord('n') << 8) | nr
+
+NILFS_IOCTL_CHANGE_CPMODE = __ioc__(1, 0x80, ctypes.sizeof(nilfs_cpmode))
+NILFS_IOCTL_GET_CPINFO = __ioc__(2, 0x82, ctypes.sizeof(nilfs_argv))
+NILFS_IOCTL_GET_CPSTAT = __ioc__(2, 0x83, ctypes.sizeof(nilfs_cpstat))
+NILFS_IOCTL_SYNC = __ioc__(2, 0x8A, ctypes.sizeof(ctypes.c_uint64))
+
+NILFS_CHECKPOINT = 0
+NILFS_SNAPSHOT = 1
+
+NILFS_CPINFO_SNAPSHOT = 1 << 0
+NILFS_CPINFO_INVALID = 1 << 1
+NILFS_CPINFO_MINOR = 1 << 3
+
+MountEntry = collections.namedtuple('MountEntry', 'dev mp fstype options')
+
+def snapshot_cno(options):
+    "Return the checkpoint number in NILFS mount @options, or None."
+    for option in options.split(','):
+        if option.startswith('cp='):
+            try:
+                return int(option[3:])
+            except ValueError:
+                return None
+    return None
+
+class MountTable:
+    """
+    Mount table parsed into indexes by device and mount point.  The
+    table is parsed again only after the kernel reports a change of
+    the mount table by POLLPRI on @path.  The file is opened again if
+    its descriptor was closed behind our back, or if the process was
+    forked, as by daemonizing, since /proc/self then names another
+    process.
+    """
+    def __init__(self, path='/proc/self/mounts'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+        self.__open__()
+        self.__load__()
+
+    def __open__(self):
+        # The old descriptor is only closed if it still refers to the
+        # file opened, since its number may have been reused by
+        # someone else after it was closed behind our back.
+        if self.fd is not None and self.__same_file__():
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.pid = os.getpid()
+        st = os.fstat(self.fd)
+        self.identity = (st.st_dev, st.st_ino)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLPRI | select.POLLERR)
+
+    def __same_file__(self):
+        "Return if @self.fd still refers to the file opened."
+        try:
+            st = os.fstat(self.fd)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino) == self.identity
+
+    def __valid__(self):
+        "Return if @self.fd can be read for the mount table."
+        return self.pid == os.getpid() and self.__same_file__()
+
+    def __read__(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def __load__(self):
+        entries = []
+        devices = {}
+        mount_points = {}
+        volumes = []
+        snapshots = {}
+        make_entry = MountEntry._make
+        for line in self.__read__().split('\n'):
+            e = line.split(None, 4)
+            if len(e) < 4:
+                continue
+            dev, mp, fstype, options = e[:4]
+            # Spaces and such are escaped in octal
+            if '\\' in dev:
+                dev = dev.decode('string_escape')
+            if '\\' in mp:
+                mp = mp.decode('string_escape')
+            entry = make_entry((dev, mp, fstype, options))
+            entries.append(entry)
+            if dev in devices:
+                devices[dev].append(entry)
+            else:
+                devices[dev] = [entry]
+            mount_points[mp] = entry
+            if fstype == 'nilfs2':
+                cno = snapshot_cno(options)
+                if cno is None:
+                    volumes.append(entry)
+                elif dev in snapshots:
+                    snapshots[dev].append((mp, cno))
+                else:
+                    snapshots[dev] = [(mp, cno)]
+        for cps in snapshots.itervalues():
+            cps.sort(key=lambda cp: cp[1])
+        self.entries = entries
+        self.devices = devices
+        self.mount_points = mount_points
+        self.volumes = volumes
+        self.snapshots = snapshots
+
+    def refresh(self):
+        "Parse the mount table again if it has changed."
+        with self.lock:
+            if not self.__valid__():
+                self.__open__()
+                self.__load__()
+            elif self.poller.poll(0):
+                self.__load__()
+
+    def reload(self):
+        "Parse the mount table again unconditionally."
+        with self.lock:
+            if not self.__valid__():
+                self.__open__()
+            self.__load__()
+
+    def by_device(self, dev):
+        "Return the list of entries mounted from @dev."
+        self.refresh()
+        return self.devices.get(dev, [])
+
+    def by_mount_point(self, mp):
+        "Return the entry mounted on @mp, or None."
+        self.refresh()
+        return self.mount_points.get(mp)
+
+    def nilfs_volumes(self):
+        "Return the list of NILFS entries which are not snapshots."
+        self.refresh()
+        return self.volumes
+
+    def nilfs_snapshots(self, dev=None):
+        """
+        Return a list of (<mount point>, <checkpoint number>) pairs of
+        the snapshots of @dev, or of all devices if @dev is None,
+        sorted by checkpoint number.
+        """
+        self.refresh()
+        if dev is not None:
+            return self.snapshots.get(dev, [])
+        return sorted((cp for cps in self.snapshots.itervalues()
+                       for cp in cps), key=lambda cp: cp[1])
+
+__mount_table__ = None
+__mount_table_lock__ = threading.Lock()
+
+def get_mount_table():
+    "Return the MountTable of this process, shared by all callers."
+    global __mount_table__
+    with __mount_table_lock__:
+        if __mount_table__ is None:
+            __mount_table__ = MountTable()
+        return __mount_table__
+
+def find_mount_point(device):
+    """
+    Return the mount point of the NILFS volume on @device, skipping
+    snapshot mounts, or None if the volume is not mounted.
+    """
+    device = os.path.realpath(device)
+    for entry in get_mount_table().nilfs_volumes():
+        if os.path.realpath(entry.dev) == device:
+            return entry.mp
+    return None
+
+class IoctlBackend:
+    """
+    Backend which issues NILFS ioctls on the mount point of the
+    volume.  @ioctl can be replaced with a callable taking the same
+    arguments as fcntl.ioctl to run without a NILFS volume.  Failed
+    ioctls are raised as IOError with the errno of the kernel.
+    """
+    def __init__(self, device, mp=None, ioctl=fcntl.ioctl, nci=512):
+        self.device = device
+        self.mp = mp if mp else find_mount_point(device)
+        if not self.mp:
+            raise IOError(errno.ENOENT, "%s is not mounted" % device)
+        self.ioctl = ioctl
+        self.cpinfos = (nilfs_cpinfo * nci)()
+        # Make sure the ioctls are available before using this backend
+        self.__get_cpinfo__(1, 1)
+
+    def __do_ioctl__(self, request, arg):
+        try:
+            fd = os.open(self.mp, os.O_RDONLY)
+        except OSError, e:
+            raise IOError(e.errno, "%s: %s" % (self.mp, e.strerror))
+        try:
+            self.ioctl(fd, request, arg, True)
+        except IOError, e:
+            raise IOError(e.errno, "%s: %s" % (self.mp, e.strerror))
+        finally:
+            os.close(fd)
+
+    def __get_cpinfo__(self, cno, nci):
+        argv = nilfs_argv(v_base=ctypes.addressof(self.cpinfos),
+                          v_nmembs=nci,
+                          v_size=ctypes.sizeof(nilfs_cpinfo),
+                          v_flags=NILFS_CHECKPOINT,
+                          v_index=cno)
+        self.__do_ioctl__(NILFS_IOCTL_GET_CPINFO, argv)
+        return argv.v_nmembs
+
+    def cpinfo(self, index):
+        "Yield checkpoints starting from checkpoint number @index"
+        ignore = NILFS_CPINFO_INVALID | NILFS_CPINFO_MINOR
+        while True:
+            n = self.__get_cpinfo__(index, len(self.cpinfos))
+            if n == 0:
+                break
+            l = [Checkpoint(int(ci.ci_cno), int(ci.ci_create),
+                            bool(ci.ci_flags & NILFS_CPINFO_SNAPSHOT))
+                 for ci in self.cpinfos[:n]
+                 if not ci.ci_flags & ignore]
+            index = int(self.cpinfos[n - 1].ci_cno) + 1
+            for cp in l:
+                yield cp
+
+    def chcp(self, cno, ss):
+        mode = nilfs_cpmode(cm_cno=cno,
+                            cm_mode=NILFS_SNAPSHOT if ss else NILFS_CHECKPOINT)
+        self.__do_ioctl__(NILFS_IOCTL_CHANGE_CPMODE, mode)
+        return ""
+
+    def chcp_many(self, cnos, ss):
+        failures = []
+        for cno in cnos:
+            try:
+                self.chcp(cno, ss)
+            except IOError, e:
+                failures.append(([cno], e.strerror, e.errno))
+        if failures:
+            raise ChcpException(failures)
+
+    def cpstat(self):
+        stat = nilfs_cpstat()
+        try:
+            self.__do_ioctl__(NILFS_IOCTL_GET_CPSTAT, stat)
+        except IOError:
+            return None
+        return int(stat.cs_cno), int(stat.cs_ncps), int(stat.cs_nsss)
+
+    def mkcp(self, ss):
+        cno = ctypes.c_uint64()
+        self.__do_ioctl__(NILFS_IOCTL_SYNC, cno)
+        if ss:
+            self.chcp(cno.value, True)
+        return ""
+
+class ControlClient:
+    """
+    Client of the control socket of the snapshot manager daemon.
+    Each request and reply is a JSON object preceded by its length as
+    a 4-byte big-endian integer.  Socket errors are raised as
+    socket.error, which is an IOError.  Connecting is retried for up
+    to @timeout seconds while the backlog of the daemon is full.
+    """
+    frame = struct.Struct('>I')
+
+    def __init__(self, path='/var/run/nilfs2_ss_manager.sock', timeout=2.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        deadline = time.time() + (timeout or 0)
+        while True:
+            try:
+                self.sock.connect(path)
+                return
+            except socket.error, e:
+                if e.errno != errno.EAGAIN or time.time() > deadline:
+                    self.sock.close()
+                    raise
+            time.sleep(0.01)
+
+    def __recv__(self, n):
+        data = ''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise socket.error("connection closed by the daemon")
+            data += chunk
+        return data
+
+    def request(self, request):
+        "Send @request and return the reply of the daemon."
+        data = json.dumps(request)
+        self.sock.sendall(self.frame.pack(len(data)) + data)
+        n = self.frame.unpack(self.__recv__(self.frame.size))[0]
+        return json.loads(self.__recv__(n))
+
+    def close(self):
+        self.sock.close()
+
+class NILFS2:
+    """
+    Checkpoint operations on a NILFS volume.  Unless @backend is
+    given, the ioctl backend is used when the volume is mounted and
+    the CLI backend otherwise.  The reason for falling back is logged
+    to @logger if it is given; @ioctl is passed to the ioctl backend.
+    """
+    def __init__(self, device, backend=None, logger=None, ioctl=fcntl.ioctl):
+        self.device = device
+        if backend is None:
+            try:
+                backend = IoctlBackend(device, ioctl=ioctl)
+            except (IOError, OSError), e:
+                if logger:
+                    # Anything but a volume which is not mounted or a
+                    # kernel without the ioctls deserves attention
+                    logger.out(syslog.LOG_INFO
+                               if e.errno in (errno.ENOENT, errno.ENOTTY)
+                               else syslog.LOG_WARNING,
+                               "%s: using the nilfs utilities: %s" %
+                               (device, e.strerror or e))
+                backend = CLIBackend(device)
+        self.backend = backend
+
+    def __parse_lscp_output__(self, cps):
+        """
+        Drop checkpoints that have the same timestamp with its
+        predecessor.  If a snapshot is present in the series of
+        coinstantaneous checkpoints, we leave it rather than plain
+        checkpoints.
+        """
+        prev = None
+        ss = None
+        for e in cps:
+            if prev is not None and e.date != prev.date:
+                yield ss if ss is not None else prev
+                ss = None
+            prev = e
+            if e.ss:
+                ss = e
+        if prev is not None:
+            yield ss if ss is not None else prev
+
+    def iter_lscp(self, index=1):
+        return self.__parse_lscp_output__(self.backend.cpinfo(index))
+
+    def lscp(self, index=1):
+        return list(self.iter_lscp(index))
+
+    def chcp(self, cno, ss=False):
+        return self.backend.chcp(cno, ss)
+
+    def chcp_many(self, cnos, ss=False):
+        """
+        Change the mode of all checkpoints in @cnos.  Checkpoints
+        which could not be changed are reported by ChcpException
+        after the others have been processed.
+        """
+        if cnos:
+            self.backend.chcp_many(cnos, ss)
+
+    def cpstat(self):
+        """
+        Return a tuple of the next checkpoint number and the numbers
+        of checkpoints and snapshots, or None if it is not available.
+        This is cheap enough to be called on every tick to find out
+        whether checkpoints have changed.
+        """
+        return self.backend.cpstat()
+
+    def mkcp(self, ss=False):
+        return self.backend.mkcp(ss)
+
 if __name__ == '__main__':
     import sys
     nilfs = NILFS2(sys.argv[1])
@@ -89,8 +650,8 @@ if __name__ == '__main__':
     for e in a:
         if e['date'] == prev['date']:
             print "%d is same as %d" % (e['cno'], prev['cno'])
-            print e['date']
-            print prev['date']
+            print time.ctime(e['date'])
+            print time.ctime(prev['date'])
         else:
             print "%d is different from %d" % (e['cno'], prev['cno'])
         prev = e
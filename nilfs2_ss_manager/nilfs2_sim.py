@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+
+"""
+Simulated NILFS volume, to run the snapshot manager without a NILFS
+disk or root privileges.
+
+SimVolume keeps the checkpoints of a volume on a simulated clock and
+removes plain checkpoints older than @gc_age as nilfs_cleanerd does.
+SimBackend can be passed to nilfs2.NILFS2 as its backend; it prints
+lscp output in the format of nilfs-utils and parses it with the
+parser of CLIBackend, and changes checkpoints like chcp, reporting
+the ones it could not change in its error lines.  SimMounts replaces the mount and umount
+commands of a snapshot manager, mounting snapshots on real
+directories only in its own table.  Every command which would have
+been run is counted in SimVolume.calls and delayed by @latency.
+"""
+
+import bisect
+import collections
+import errno
+import os
+import re
+import time
+
+import nilfs2
+
+class SimClock:
+    """
+    Simulated clock standing in for the time module.  Everything but
+    time() is taken from the time module.
+    """
+    def __init__(self, now=1300000000):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class SimVolume:
+    """
+    Checkpoints of a simulated volume, ordered by checkpoint number.
+    Removed checkpoints are left as None in @cps until more than half
+    of the list is garbage.  Like a new file system, the volume starts
+    with one checkpoint, and its latest checkpoint is never removed.
+    """
+    def __init__(self, clock, gc_age=3600, latency=0, device='/dev/sim'):
+        self.clock = clock
+        self.gc_age = gc_age
+        self.latency = latency
+        self.device = device
+        self.cps = []
+        self.cnos = []
+        self.index = {}
+        self.next_cno = 1
+        self.live = 0
+        self.snapshots = 0
+        self.mounted = set()
+        self.calls = collections.Counter()
+        self.__gc_next__ = 0
+        self.checkpoint()
+
+    def command(self, name):
+        "Count a command run on the volume and wait for it to finish"
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def find(self, cno):
+        "Return the checkpoint @cno, or None if it does not exist."
+        i = self.index.get(cno)
+        return self.cps[i] if i is not None else None
+
+    def checkpoint(self, ss=False, date=None):
+        "Create a checkpoint at @date, or now, and return it."
+        cp = nilfs2.Checkpoint(self.next_cno,
+                               int(self.clock.now if date is None else date),
+                               ss)
+        self.index[cp.cno] = len(self.cps)
+        self.cps.append(cp)
+        self.cnos.append(cp.cno)
+        self.next_cno += 1
+        self.live += 1
+        if ss:
+            self.snapshots += 1
+        return cp
+
+    def advance(self, seconds, rate=1.0):
+        """
+        Move the clock forward by @seconds, creating @rate checkpoints
+        per second evenly over the period, and collect garbage.
+        """
+        start = self.clock.now
+        count = int(seconds * rate)
+        for i in xrange(1, count + 1):
+            self.checkpoint(date=start + i * seconds / float(count))
+        self.clock.now = start + seconds
+        self.gc()
+
+    def history(self, seconds, rate=1.0, every=600):
+        """
+        Move the clock forward by @seconds of checkpoints created at
+        @rate per second, of which only a snapshot every @every
+        seconds is left, as if they had been thinned out.
+        """
+        start = self.clock.now
+        first = self.next_cno
+        count = int(seconds * rate)
+        for i in xrange(0, count, max(int(every * rate), 1)):
+            self.next_cno = first + i
+            self.checkpoint(True, start + i / rate)
+        self.next_cno = first + count
+        self.clock.now = start + seconds
+
+    def remove(self, cno):
+        "Remove the plain checkpoint @cno"
+        i = self.index.pop(cno)
+        self.cps[i] = None
+        self.live -= 1
+
+    def gc(self):
+        "Remove plain checkpoints older than @gc_age"
+        limit = self.clock.now - self.gc_age
+        cps = self.cps
+        i = self.__gc_next__
+        while i < len(cps) - 1 and (cps[i] is None or cps[i].date < limit):
+            if cps[i] is not None and not cps[i].ss:
+                self.remove(cps[i].cno)
+            i += 1
+        self.__gc_next__ = i
+        if len(self.cps) - self.live > len(self.cps) / 2:
+            self.__compact__()
+
+    def __compact__(self):
+        head = sum(1 for cp in self.cps[:self.__gc_next__] if cp is not None)
+        self.cps = [cp for cp in self.cps if cp is not None]
+        self.cnos = [cp.cno for cp in self.cps]
+        self.index = dict((cno, i) for i, cno in enumerate(self.cnos))
+        self.__gc_next__ = head
+
+    def chcp(self, cno, ss):
+        "Change the mode of the checkpoint @cno"
+        cp = self.find(cno)
+        if cp is None:
+            raise Exception(os.strerror(errno.ENOENT))
+        if not ss and cno in self.mounted:
+            raise Exception(os.strerror(errno.EBUSY))
+        if cp.ss != ss:
+            self.snapshots += 1 if ss else -1
+            cp.ss = ss
+        if not ss and cp.date < self.clock.now - self.gc_age:
+            self.remove(cno)
+
+    def iter_from(self, index):
+        "Yield existing checkpoints from the checkpoint number @index"
+        for cp in self.cps[bisect.bisect_left(self.cnos, index):]:
+            if cp is not None:
+                yield cp
+
+class SimBackend(nilfs2.CLIBackend):
+    """
+    nilfs2 backend over a SimVolume.  Checkpoint lists go through the
+    lscp output format, and checkpoint counters are available unless
+    @cpstat is False.
+    """
+    header = ("                 CNO        DATE     TIME  MODE  FLG"
+              "      BLKCNT       ICNT")
+
+    def __init__(self, volume, cpstat=True):
+        nilfs2.CLIBackend.__init__(self, volume.device)
+        self.volume = volume
+        self.has_cpstat = cpstat
+        self.__day__ = (None, None)
+
+    def __line__(self, cp):
+        minute = cp.date - cp.date % 60
+        if self.__day__[0] != minute:
+            self.__day__ = (minute, time.strftime("%Y-%m-%d %H:%M",
+                                                  time.localtime(minute)))
+        return "%20d  %s:%02d   %s    -  %10d %10d" % (
+            cp.cno, self.__day__[1], cp.date % 60, 'ss' if cp.ss else 'cp',
+            16, 4)
+
+    def lscp_output(self, index):
+        "Yield the lines lscp would print from checkpoint @index"
+        yield self.header
+        for cp in self.volume.iter_from(index):
+            yield self.__line__(cp)
+
+    def cpinfo(self, index):
+        self.volume.command('lscp')
+        return self.__parse_lscp_lines__(self.lscp_output(index), [])
+
+    def __run_cmd__(self, line):
+        args = line.split()
+        if args[0] == 'mkcp':
+            self.volume.command(args[0])
+            self.volume.checkpoint('-s' in args)
+            return ''
+        status, output = self.__chcp_run__(args)
+        if status != 0:
+            raise Exception(output)
+        return output
+
+    def __chcp_run__(self, args):
+        """
+        Change the checkpoints like the chcp command, and return its
+        exit status and the error lines it would print.
+        """
+        self.volume.command('chcp')
+        errors = []
+        for arg in args[3:]:
+            try:
+                self.volume.chcp(int(arg), args[1] == 'ss')
+            except Exception, e:
+                errors.append("chcp: %s: %s: %s" % (args[2], arg, e))
+        return (1 if errors else 0), "\n".join(errors)
+
+    def cpstat(self):
+        if not self.has_cpstat:
+            return None
+        v = self.volume
+        return (v.next_cno, v.live, v.snapshots)
+
+class SimMounts:
+    """
+    Table of simulated snapshot mounts on real directories.  Mounts
+    listed in @busy fail to unmount as if they were in use, unless
+    they are detached lazily.
+    """
+    def __init__(self, volume):
+        self.volume = volume
+        self.mounts = {}
+        self.busy = set()
+
+    def run_command(self, op, cmd):
+        "Pretend to run the mount or umount command @cmd"
+        args = cmd.split()
+        self.volume.command(args[0])
+        target = args[-1]
+        if 'tmpfs' in args:
+            return (0, '')
+        if args[0] == 'mount':
+            cno = int(re.search(r'cp=(\d+)', cmd).group(1))
+            cp = self.volume.find(cno)
+            if not os.path.isdir(target):
+                return (8192, "mount: mount point %s does not exist" % target)
+            if cp is None or not cp.ss or target in self.mounts:
+                return (8192, "mount: %s is busy" % self.volume.device)
+            self.mounts[target] = cno
+            self.volume.mounted.add(cno)
+            return (0, '')
+        if target in self.busy and '-l' not in args:
+            return (256, "umount: %s: device is busy." % target)
+        if target not in self.mounts:
+            return (256, "umount: %s: not mounted" % target)
+        self.volume.mounted.discard(self.mounts.pop(target))
+        return (0, '')
+
+    def ismount(self, path):
+        return path in self.mounts
+
+    def attach(self, manager):
+        "Make @manager mount its snapshots in this table"
+        prefix = manager.mp + '/'
+        manager.run_command = self.run_command
+        manager.ismount = self.ismount
+        manager.scan_mounts = lambda: [mp for mp in self.mounts
+                                       if mp.startswith(prefix)]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of batched checkpoint mode changes.
+
+The error lines chcp prints for the checkpoints it could not change
+are parsed by the CLI backend into one failure per checkpoint, with
+the errno of the message.  The manager must drop the checkpoints
+the cleaner removed from its cache, logging them below LOG_ERR, and
+record the others which were changed.
+"""
+
+import errno
+import shutil
+import syslog
+import tempfile
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+
+class Logger:
+    def __init__(self):
+        self.messages = []
+
+    def out(self, prio, string):
+        self.messages.append((prio, string))
+
+class ChcpTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        self.clock = nilfs2_sim.SimClock()
+        self.dm = load_daemon(self.clock)
+        self.volume = nilfs2_sim.SimVolume(self.clock)
+        for i in xrange(10):
+            self.clock.now += 60
+            self.volume.checkpoint()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_failures(self):
+        ns = nilfs2.NILFS2(self.volume.device,
+                           nilfs2_sim.SimBackend(self.volume))
+        self.volume.mounted.add(4)
+        self.volume.chcp(4, True)
+        self.volume.remove(6)
+        try:
+            ns.chcp_many([3, 4, 5, 6, 7], False)
+        except nilfs2.ChcpException, e:
+            self.assertEqual([(cnos, err) for cnos, message, err in
+                              e.failures],
+                             [([4], errno.EBUSY), ([6], errno.ENOENT)])
+        else:
+            self.fail("no ChcpException")
+        self.assertEqual(self.volume.calls['chcp'], 1)
+
+    def test_manager(self):
+        ns = nilfs2.NILFS2(self.volume.device,
+                           nilfs2_sim.SimBackend(self.volume))
+        logger = Logger()
+        manager = self.dm.NILFSSSManager(
+            ns, self.root, logger, interval=60, threshold=600,
+            protection_period=3600, protection_max=86400)
+        self.volume.remove(5)
+        self.volume.remove(8)
+        done = manager.chcp_many([manager.find_cp(cno)
+                                  for cno in (4, 5, 6, 8)], True)
+        self.assertEqual([cp.cno for cp in done], [4, 6])
+        self.assertEqual([cp.cno for cp in manager.cps if cp.ss], [4, 6])
+        self.assertEqual(manager.find_cp(5), None)
+        self.assertEqual(manager.find_cp(8), None)
+        self.assertEqual([prio for prio, string in logger.messages],
+                         [syslog.LOG_INFO, syslog.LOG_INFO])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of the control socket of the daemon.
+
+A ControlServer listens on a socket in a temporary directory for a
+manager of a simulated volume, and is driven by MainLoop, a small
+stand-in for the gobject main loop running its watches with select().
+Clients connect with nilfs2.ControlClient from threads of their own,
+many at a time, while the loop runs on the main thread.
+"""
+
+import json
+import os
+import select
+import shutil
+import syslog
+import tempfile
+import threading
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+
+class MainLoop:
+    "The parts of the gobject module the control server uses"
+    IO_IN, IO_OUT, IO_PRI, IO_ERR, IO_HUP = 1, 4, 2, 8, 16
+
+    def __init__(self):
+        self.watches = {}
+        self.idle = []
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def io_add_watch(self, obj, condition, callback):
+        with self.lock:
+            source = self.next_id
+            self.next_id += 1
+            self.watches[source] = (obj, condition, callback)
+        return source
+
+    def source_remove(self, source):
+        with self.lock:
+            self.watches.pop(source, None)
+
+    def idle_add(self, callback, *args):
+        with self.lock:
+            self.idle.append((callback, args))
+
+    def iterate(self, timeout=0.01):
+        "Run the idle callbacks and then the watches which are ready"
+        with self.lock:
+            idle, self.idle = self.idle, []
+            watches = self.watches.items()
+        for callback, args in idle:
+            callback(*args)
+        readers = [obj for source, (obj, cond, cb) in watches
+                   if cond & ~self.IO_OUT]
+        writers = [obj for source, (obj, cond, cb) in watches
+                   if cond & self.IO_OUT]
+        r, w, x = select.select(readers, writers, [], timeout)
+        for source, (obj, cond, callback) in watches:
+            if source not in self.watches:
+                continue
+            if ((obj in r and cond & ~self.IO_OUT) or
+                (obj in w and cond & self.IO_OUT)):
+                if not callback(obj, cond):
+                    self.source_remove(source)
+
+    def run_until(self, done):
+        while not done():
+            self.iterate()
+
+class CallThread:
+    "ManagerThread running every call on a thread of its own at once"
+    def __init__(self, loop):
+        self.loop = loop
+
+    def call(self, func, callback):
+        def run():
+            result = error = None
+            try:
+                result = func()
+            except Exception, e:
+                error = str(e)
+            self.loop.idle_add(callback, result, error)
+        threading.Thread(target=run).start()
+
+class ControlTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        self.clock = nilfs2_sim.SimClock()
+        self.dm = load_daemon(self.clock)
+        self.loop = MainLoop()
+        self.dm.gobject = self.loop
+
+        # The volume is mounted on /vol as far as the daemon can tell
+        table = os.path.join(self.root, 'mounts')
+        with open(table, 'w') as f:
+            f.write("/dev/sim /vol nilfs2 rw,relatime 0 0\n")
+        self.saved_table = nilfs2.__mount_table__
+        nilfs2.__mount_table__ = nilfs2.MountTable(table)
+
+        self.volume = nilfs2_sim.SimVolume(self.clock, device='/dev/sim')
+        for i in xrange(20):
+            self.clock.now += 600
+            self.volume.checkpoint(True)
+        mp = os.path.join(self.root, 'mnt')
+        os.mkdir(mp)
+        logger = self.dm.Logger(priomask=syslog.LOG_UPTO(syslog.LOG_WARNING))
+        ns = nilfs2.NILFS2(self.volume.device,
+                           nilfs2_sim.SimBackend(self.volume))
+        # Only the snapshots of the last hour are mounted up front
+        self.manager = self.dm.NILFSSSManager(
+            ns, mp, logger, lazy=True, mount_window=3600, interval=60,
+            threshold=600, protection_period=3600, protection_max=86400,
+            protection=self.dm.ProtectionFile(self.root, '/dev/sim'))
+        self.mounts = nilfs2_sim.SimMounts(self.volume)
+        self.mounts.attach(self.manager)
+        self.manager.thread = CallThread(self.loop)
+        self.pool = self.dm.MountPool(2, logger)
+        self.manager.pool = self.pool
+        self.manager.mount_ss()
+        self.loop.run_until(lambda: not self.pool.pending)
+
+        self.path = os.path.join(self.root, 'sock')
+        self.server = self.dm.ControlServer(self.path, [self.manager],
+                                            self.pool, logger)
+
+    def tearDown(self):
+        self.server.close()
+        self.pool.stop()
+        nilfs2.__mount_table__ = self.saved_table
+        shutil.rmtree(self.root)
+
+    def request(self, request):
+        "Send @request from a client thread and return the reply"
+        replies = []
+        def client():
+            c = nilfs2.ControlClient(self.path)
+            try:
+                replies.append(c.request(request))
+            finally:
+                c.close()
+        t = threading.Thread(target=client)
+        t.start()
+        self.loop.run_until(lambda: not t.isAlive())
+        return replies[0]
+
+    def dispatch(self, request, uid):
+        "Run @request as if sent by @uid and return the reply"
+        replies = []
+        self.server.dispatch(json.dumps(request), replies.append, uid)
+        self.loop.run_until(lambda: replies)
+        return replies[0]
+
+    def test_list(self):
+        r = self.request({'cmd': 'list', 'id': 7})
+        self.assertEqual(r['id'], 7)
+        self.assertEqual(r['device'], '/dev/sim')
+        self.assertEqual([e['cno'] for e in r['snapshots']], range(2, 22))
+        self.assertEqual(len([e for e in r['snapshots'] if 'mp' in e]), 6)
+
+    def test_versions_and_lazy_mount(self):
+        r = self.request({'cmd': 'versions', 'path': '/vol/some/file'})
+        self.assertEqual(r['mp'], '/vol')
+        snapshots = r['snapshots']
+        self.assertEqual([cno for mp, cno in snapshots], range(2, 22))
+        unmounted = [cno for mp, cno in snapshots if mp is None]
+        self.assertEqual(len(unmounted), 14)
+        r = self.request({'cmd': 'mount', 'cno': unmounted[0]})
+        self.assertTrue(self.mounts.ismount(r['mp']))
+        r = self.request({'cmd': 'versions', 'path': '/vol'})
+        self.assertEqual([cno for mp, cno in r['snapshots'] if mp is None],
+                         unmounted[1:])
+
+    def test_errors(self):
+        self.assertTrue('error' in self.request({'cmd': 'nothing'}))
+        self.assertTrue('error' in self.request({'cmd': 'mount', 'cno': 1}))
+        self.assertTrue('error' in self.request({'cmd': 'versions',
+                                                 'path': '/elsewhere'}))
+        self.assertTrue('error' in self.dispatch({'cmd': 'list',
+                                                  'device': '/dev/x'}, 0))
+        self.assertEqual(self.dispatch({'cmd': 'protect', 'cno': 5}, 1000),
+                         {'error': "permission denied"})
+
+    def test_protect_and_delete(self):
+        self.assertEqual(self.dispatch({'cmd': 'protect', 'cno': 5}, 0),
+                         {'cno': 5})
+        self.assertEqual(self.manager.protected, set([5]))
+        self.assertEqual(self.manager.protection.load(), set([5]))
+        self.assertEqual(self.dispatch({'cmd': 'delete', 'cno': 21}, 0),
+                         {'cno': 21})
+        self.assertFalse(self.volume.find(21).ss)
+        self.assertFalse(self.manager.find_cp(21).ss)
+        self.assertTrue('error' in self.dispatch({'cmd': 'delete',
+                                                  'cno': 21}, 0))
+        self.assertEqual(self.dispatch({'cmd': 'delete', 'cno': 5}, 0),
+                         {'cno': 5})
+        self.assertEqual(self.manager.protection.load(), set())
+
+    def test_concurrent_clients(self):
+        n = 50
+        replies = []
+        lock = threading.Lock()
+        def client(i):
+            c = nilfs2.ControlClient(self.path, timeout=10)
+            try:
+                r = c.request({'cmd': 'list', 'id': i})
+                r2 = c.request({'cmd': 'versions', 'path': '/vol', 'id': i})
+            finally:
+                c.close()
+            with lock:
+                replies.append((i, r, r2))
+        threads = [threading.Thread(target=client, args=(i,))
+                   for i in xrange(n)]
+        for t in threads:
+            t.start()
+        self.loop.run_until(lambda: not any(t.isAlive() for t in threads))
+        self.assertEqual(sorted(i for i, r, r2 in replies), range(n))
+        for i, r, r2 in replies:
+            self.assertEqual((r['id'], r2['id']), (i, i))
+            self.assertEqual(len(r['snapshots']), 20)
+            self.assertEqual(len(r2['snapshots']), 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Randomized equivalence tests of the checkpoint cache merges.
+
+NILFSSSManager.__refresh_cp_cache__ and __join_cp_list__ are run on
+randomly generated pairs of a cached checkpoint list and a fresh lscp
+list, and compared with the implementation they replaced, kept here
+as OldCache.  Set the seed and number of cases with --seed and
+--cases.  The cache file must be trusted after every save, also after
+a crash, until the checkpoint list changes.
+"""
+
+import copy
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import nilfs2
+from bench_manager import load_daemon
+
+CASES = 2000
+SEED = 1
+
+class OldCache:
+    "Checkpoint cache merges of the manager before they were linear"
+    def __init__(self, cps):
+        self.cps = cps
+
+    def __join_cp_list__(self, l, last):
+        if l and l[0]['date'] == last['date']:
+            if last['ss']:
+                del l[0]
+            else:
+                del self.cps[-1]
+        self.cps += l
+
+    def __refresh_cp_cache__(self, l):
+        for cp in self.cps[:]:
+            while l and cp['cno'] > l[0]['cno']:
+                del l[0]
+            if cp['ss']:
+                pass
+            else:
+                if not l or cp['cno'] < l[0]['cno']:
+                    self.cps.remove(cp)
+                else:
+                    if l[0]['ss']:
+                        cp['ss'] = True
+
+        if not self.cps:
+            self.cps = l
+        else:
+            last = self.cps[-1]
+            while l and l[0]['cno'] <= last['cno']:
+                del l[0]
+            self.__join_cp_list__(l, last)
+
+class FakeNILFS2:
+    device = '/dev/test'
+
+    def lscp(self, index=1):
+        return []
+
+def make_manager(dm):
+    return dm.NILFSSSManager(FakeNILFS2(), '/', dm.Logger(),
+                             interval=60, threshold=600,
+                             protection_period=3600, protection_max=86400)
+
+def random_history(rand):
+    """
+    Return a random cached list and the fresh list lscp would return
+    after checkpoints were deleted, changed and created.  Neither list
+    has coinstantaneous checkpoints, except that the first new
+    checkpoint may share the timestamp of the last cached one.
+    """
+    cps = []
+    cno = rand.randint(1, 5)
+    date = 1300000000
+    for i in xrange(rand.randint(0, 30)):
+        cps.append(nilfs2.Checkpoint(cno, date, rand.random() < 0.3))
+        cno += rand.randint(1, 3)
+        date += rand.randint(1, 100)
+    fresh = []
+    for cp in cps:
+        if rand.random() < 0.3:
+            continue   # deleted by the cleaner or by hand
+        ss = cp.ss
+        if rand.random() < 0.2:
+            ss = not ss   # changed by hand
+        fresh.append(nilfs2.Checkpoint(cp.cno, cp.date, ss))
+    if cps and rand.random() < 0.3:
+        date = cps[-1].date
+    for i in xrange(rand.randint(0, 5)):
+        fresh.append(nilfs2.Checkpoint(cno, date, rand.random() < 0.3))
+        cno += 1
+        date += rand.randint(1, 100)
+    return cps, fresh
+
+def summary(cps):
+    return [(cp['cno'], cp['date'], cp['ss']) for cp in cps]
+
+class CheckpointCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = load_daemon(time)
+
+    def setUp(self):
+        self.manager = make_manager(self.dm)
+        self.rand = random.Random(SEED)
+
+    def test_refresh(self):
+        for i in xrange(CASES):
+            cps, fresh = random_history(self.rand)
+            if not cps:
+                continue
+            old = OldCache(copy.deepcopy(cps))
+            old.__refresh_cp_cache__(copy.deepcopy(fresh))
+            self.manager.cps = copy.deepcopy(cps)
+            self.manager.__refresh_cp_cache__(copy.deepcopy(fresh))
+            self.assertEqual(summary(self.manager.cps), summary(old.cps),
+                             "case %d: %r %r" % (i, cps, fresh))
+
+    def test_join(self):
+        for i in xrange(CASES):
+            cps, fresh = random_history(self.rand)
+            if not cps:
+                continue
+            new = [cp for cp in fresh if cp.cno > cps[-1].cno]
+            old = OldCache(copy.deepcopy(cps))
+            old.__join_cp_list__(copy.deepcopy(new), old.cps[-1])
+            self.manager.cps = copy.deepcopy(cps)
+            self.manager.__join_cp_list__(copy.deepcopy(new),
+                                          self.manager.cps[-1])
+            self.assertEqual(summary(self.manager.cps), summary(old.cps),
+                             "case %d: %r %r" % (i, cps, new))
+
+class CacheFileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = load_daemon(time)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        self.cps = [nilfs2.Checkpoint(cno, 1300000000 + cno * 60,
+                                       cno % 2 == 1)
+                    for cno in xrange(1, 20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_clean(self):
+        cache = self.dm.CheckpointCache(self.root, '/dev/test')
+        self.assertEqual(cache.load(), None)
+        cache.save(self.cps, set([3]))
+        # Loading does not spoil the cache for a crash which follows
+        for i in xrange(2):
+            cache = self.dm.CheckpointCache(self.root, '/dev/test')
+            self.assertEqual(summary(cache.load()), summary(self.cps))
+            self.assertEqual(cache.protected, set([3]))
+        cache.mark_dirty()
+        self.assertEqual(self.dm.CheckpointCache(self.root,
+                                                 '/dev/test').load(), None)
+        cache.save(self.cps[:5])
+        self.assertEqual(summary(cache.load()), summary(self.cps[:5]))
+
+    def test_manager(self):
+        cache = self.dm.CheckpointCache(self.root, '/dev/test')
+        cache.save(self.cps)
+        ns = FakeNILFS2()
+        ns.lscp = lambda index=1: [cp for cp in self.cps if cp.cno >= index]
+        ns.chcp_many = lambda cnos, ss: None
+        manager = self.dm.NILFSSSManager(
+            ns, '/', self.dm.Logger(), interval=60, threshold=600,
+            protection_period=3600, protection_max=86400, cache=cache,
+            cache_flush=3600)
+        manager.chcp_many([manager.find_cp(3)])
+        self.assertEqual(self.dm.CheckpointCache(self.root,
+                                                 '/dev/test').load(), None)
+        manager.cache_flush = 0
+        manager.flush_cp_cache()
+        saved = self.dm.CheckpointCache(self.root, '/dev/test').load()
+        self.assertEqual([cp.cno for cp in saved if cp.ss],
+                         [1, 5, 7, 9, 11, 13, 15, 17, 19])
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    for name in ('--seed', '--cases'):
+        if name in args:
+            i = args.index(name)
+            globals()[name[2:].upper()] = int(args[i + 1])
+            del args[i:i + 2]
+    unittest.main(argv=sys.argv[:1] + args)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of the checkpoint counter probe and of the polling backoff.
+
+The CLI backend reads the checkpoint counters from a fake NILFS sysfs
+tree in a temporary directory, and a manager on a simulated volume
+must only list checkpoints when the counters written there change.
+Without counters, ManagerThread must double its period while the
+volume is idle and go back to the base period on new checkpoints.
+"""
+
+import os
+import shutil
+import syslog
+import tempfile
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+
+class SysfsBackend(nilfs2_sim.SimBackend):
+    "Simulated backend reading its counters from a sysfs tree"
+    def __init__(self, volume, sysfs):
+        nilfs2_sim.SimBackend.__init__(self, volume)
+        nilfs2.CLIBackend.__init__(self, volume.device, sysfs)
+
+    cpstat = nilfs2.CLIBackend.cpstat
+
+def write_counters(sysfs, device, counters):
+    d = os.path.join(sysfs, os.path.basename(device), 'checkpoints')
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    for name, value in zip(('next_checkpoint', 'checkpoints_number',
+                            'snapshots_number'), counters):
+        with open(os.path.join(d, name), 'w') as f:
+            f.write("%d\n" % value)
+
+class FakeEvent:
+    "Wakeup event of a ManagerThread recording how long it waits"
+    def __init__(self, thread, each):
+        self.thread = thread
+        self.each = each
+        self.waits = []
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.each(len(self.waits))
+        return False
+
+    def set(self):
+        pass
+
+    def clear(self):
+        pass
+
+class CpstatTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        self.sysfs = os.path.join(self.root, 'sys')
+        self.clock = nilfs2_sim.SimClock()
+        self.dm = load_daemon(self.clock)
+        self.volume = nilfs2_sim.SimVolume(self.clock, device='/dev/sim0')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def manager(self, backend):
+        ns = nilfs2.NILFS2(self.volume.device, backend)
+        manager = self.dm.NILFSSSManager(
+            ns, self.root,
+            self.dm.Logger(priomask=syslog.LOG_UPTO(syslog.LOG_WARNING)),
+            interval=60, threshold=600, protection_period=3600,
+            protection_max=86400)
+        nilfs2_sim.SimMounts(self.volume).attach(manager)
+        return manager
+
+    def test_read_counters(self):
+        backend = nilfs2.CLIBackend('/dev/sim0', self.sysfs)
+        self.assertEqual(backend.cpstat(), None)
+        write_counters(self.sysfs, '/dev/sim0', (12, 5, 2))
+        self.assertEqual(backend.cpstat(), (12, 5, 2))
+        with open(os.path.join(self.sysfs, 'sim0', 'checkpoints',
+                               'snapshots_number'), 'w') as f:
+            f.write("garbage\n")
+        self.assertEqual(backend.cpstat(), None)
+
+    def test_scan_on_change(self):
+        write_counters(self.sysfs, self.volume.device, (2, 1, 0))
+        manager = self.manager(SysfsBackend(self.volume, self.sysfs))
+        self.assertTrue(manager.update())
+        scans = self.volume.calls['lscp']
+        for i in xrange(10):
+            self.clock.now += 5
+            self.assertFalse(manager.update())
+        self.assertEqual(self.volume.calls['lscp'], scans)
+        self.assertTrue(manager.probing)
+
+        # A checkpoint shows up only once the counters say so
+        self.clock.now += 5
+        cp = self.volume.checkpoint()
+        self.assertFalse(manager.update())
+        self.assertFalse(cp.ss)
+        write_counters(self.sysfs, self.volume.device, (3, 2, 0))
+        self.assertTrue(manager.update())
+        self.assertEqual(self.volume.calls['lscp'], scans + 1)
+        self.assertTrue(cp.ss)
+
+    def test_backoff(self):
+        manager = self.manager(nilfs2_sim.SimBackend(self.volume, False))
+        thread = self.dm.ManagerThread(manager, 5, None, manager.logger, 60)
+        def each(n):
+            self.clock.now += 1
+            if n == 7:
+                self.volume.checkpoint()
+            elif n == 9:
+                thread.stopping = True
+        thread.wakeup = FakeEvent(thread, each)
+        thread.run()
+        self.assertFalse(manager.probing)
+        self.assertEqual(thread.wakeup.waits,
+                         [5, 10, 20, 40, 60, 60, 60, 5, 10])
+
+if __name__ == '__main__':
+    unittest.main()
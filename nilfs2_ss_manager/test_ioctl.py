@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of the ioctl backend through a fake ioctl layer.
+
+FakeIoctl serves the NILFS ioctls from a list of checkpoints, reading
+and writing the argument structures as raw bytes laid out as in
+linux/nilfs2_api.h, so that the ctypes structures of nilfs2 are
+checked against the layout of the kernel.  NILFS2 must fall back to
+the CLI backend with a logged reason when the ioctls are not
+available, and must not hide any other failure.
+"""
+
+import ctypes
+import errno
+import os
+import shutil
+import struct
+import syslog
+import tempfile
+import unittest
+
+import nilfs2
+
+# Layouts of the kernel structures
+CPINFO = struct.Struct('<IIQQQQQQ')
+ARGV = struct.Struct('<QIHHQ')
+CPMODE = struct.Struct('<QII')
+CPSTAT = struct.Struct('<QQQ')
+
+def raw(arg):
+    return ctypes.string_at(ctypes.addressof(arg), ctypes.sizeof(arg))
+
+def store(arg, data):
+    ctypes.memmove(ctypes.addressof(arg), data, len(data))
+
+class FakeIoctl:
+    "NILFS ioctls on a list of (cno, date, flags) checkpoints"
+    def __init__(self, cps):
+        self.cps = [list(cp) for cp in cps]
+        self.calls = []
+
+    def find(self, cno):
+        for cp in self.cps:
+            if cp[0] == cno:
+                return cp
+        return None
+
+    def __call__(self, fd, request, arg, mutate):
+        self.calls.append(request)
+        if request == 0x80186e82:  # NILFS_IOCTL_GET_CPINFO
+            base, nmembs, size, flags, index = ARGV.unpack(raw(arg))
+            assert size == CPINFO.size and flags == 0
+            cps = [cp for cp in self.cps if cp[0] >= index][:nmembs]
+            for i, (cno, date, cflags) in enumerate(cps):
+                ctypes.memmove(base + i * size,
+                               CPINFO.pack(cflags, 0, cno, date, 1, 2, 3,
+                                           cno + 1), size)
+            store(arg, ARGV.pack(base, len(cps), size, flags, index))
+        elif request == 0x40106e80:  # NILFS_IOCTL_CHANGE_CPMODE
+            cno, mode, pad = CPMODE.unpack(raw(arg))
+            cp = self.find(cno)
+            if cp is None:
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT))
+            if mode:
+                cp[2] |= nilfs2.NILFS_CPINFO_SNAPSHOT
+            else:
+                cp[2] &= ~nilfs2.NILFS_CPINFO_SNAPSHOT
+        elif request == 0x80186e83:  # NILFS_IOCTL_GET_CPSTAT
+            store(arg, CPSTAT.pack(
+                self.cps[-1][0] + 1, len(self.cps),
+                sum(1 for cp in self.cps
+                    if cp[2] & nilfs2.NILFS_CPINFO_SNAPSHOT)))
+        elif request == 0x80086e8a:  # NILFS_IOCTL_SYNC
+            cno = self.cps[-1][0] + 1
+            self.cps.append([cno, self.cps[-1][1] + 1, 0])
+            store(arg, struct.pack('<Q', cno))
+        else:
+            raise IOError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+
+class Logger:
+    def __init__(self):
+        self.messages = []
+
+    def out(self, prio, string):
+        self.messages.append((prio, string))
+
+class IoctlTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        table = os.path.join(self.root, 'mounts')
+        with open(table, 'w') as f:
+            f.write("/dev/fake %s nilfs2 rw,relatime 0 0\n" % self.root)
+        self.saved_table = nilfs2.__mount_table__
+        nilfs2.__mount_table__ = nilfs2.MountTable(table)
+        minor = nilfs2.NILFS_CPINFO_MINOR
+        ss = nilfs2.NILFS_CPINFO_SNAPSHOT
+        self.ioctl = FakeIoctl([(1, 1000, 0), (2, 1000, ss), (3, 1010, minor),
+                                (4, 1020, 0)] +
+                               [(cno, 1000 + cno * 10, ss)
+                                for cno in xrange(5, 1200)])
+
+    def tearDown(self):
+        nilfs2.__mount_table__ = self.saved_table
+        shutil.rmtree(self.root)
+
+    def test_lscp(self):
+        ns = nilfs2.NILFS2('/dev/fake', ioctl=self.ioctl)
+        self.assertTrue(isinstance(ns.backend, nilfs2.IoctlBackend))
+        cps = ns.lscp()
+        # Coinstantaneous checkpoints are shrunk to the snapshot, and
+        # minor checkpoints are left out
+        self.assertEqual([(cp.cno, cp.date, cp.ss) for cp in cps[:3]],
+                         [(2, 1000, True), (4, 1020, False),
+                          (5, 1050, True)])
+        self.assertEqual(len(cps), 1197)
+        self.assertEqual(cps[-1].cno, 1199)
+        self.assertEqual([cp.cno for cp in ns.lscp(index=1198)], [1198, 1199])
+        self.assertEqual(ns.cpstat(), (1200, 1199, 1196))
+
+    def test_chcp(self):
+        ns = nilfs2.NILFS2('/dev/fake', ioctl=self.ioctl)
+        ns.chcp(4, True)
+        self.assertTrue(ns.lscp(index=4)[0].ss)
+        try:
+            ns.chcp_many([5, 6000, 7], False)
+        except nilfs2.ChcpException, e:
+            self.assertEqual(e.failures, [([6000], "%s: %s" % (
+                self.root, os.strerror(errno.ENOENT)), errno.ENOENT)])
+        else:
+            self.fail("no ChcpException")
+        self.assertEqual([cp.ss for cp in ns.lscp(index=5)[:3]],
+                         [False, True, False])
+        ns.mkcp(True)
+        self.assertEqual(ns.lscp(index=1200)[0].cno, 1200)
+        self.assertTrue(ns.lscp(index=1200)[0].ss)
+
+    def test_fallback(self):
+        def enotty(fd, request, arg, mutate):
+            raise IOError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+        logger = Logger()
+        ns = nilfs2.NILFS2('/dev/fake', logger=logger, ioctl=enotty)
+        self.assertTrue(isinstance(ns.backend, nilfs2.CLIBackend))
+        self.assertEqual(logger.messages[0][0], syslog.LOG_INFO)
+        self.assertTrue(os.strerror(errno.ENOTTY) in logger.messages[0][1])
+
+        # An unmounted volume falls back quietly
+        logger = Logger()
+        ns = nilfs2.NILFS2('/dev/other', logger=logger, ioctl=self.ioctl)
+        self.assertTrue(isinstance(ns.backend, nilfs2.CLIBackend))
+        self.assertEqual(logger.messages[0][0], syslog.LOG_INFO)
+
+        # Other failures are worth a warning
+        def eperm(fd, request, arg, mutate):
+            raise IOError(errno.EPERM, os.strerror(errno.EPERM))
+        logger = Logger()
+        nilfs2.NILFS2('/dev/fake', logger=logger, ioctl=eperm)
+        self.assertEqual(logger.messages[0][0], syslog.LOG_WARNING)
+
+    def test_broken_layout(self):
+        # A bug in the structures must not be mistaken for a kernel
+        # without the ioctls
+        def broken(fd, request, arg, mutate):
+            raise TypeError("bad argument")
+        self.assertRaises(TypeError, nilfs2.NILFS2, '/dev/fake',
+                          ioctl=broken)
+
+if __name__ == '__main__':
+    unittest.main()
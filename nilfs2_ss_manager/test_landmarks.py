@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Randomized equivalence tests of the landmark computation.
+
+On its first call, NILFSSSManager.__find_landmarks__ must choose the
+same landmarks and thinning targets over a random checkpoint history
+as the full scan it replaced, kept here as old_landmarks().  On the
+following calls, as checkpoints are added and some of the targets
+fail to be thinned, it must choose the same targets as the full scan
+of the snapshots left.  Set the seed and number of cases with --seed
+and --cases.
+"""
+
+import random
+import sys
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+
+CASES = 2000
+SEED = 1
+
+def old_landmarks(cps, now, interval, threshold, protection_period,
+                  protection_max):
+    """
+    Landmarks and thinning targets of the manager before thinning was
+    incremental, reading the epoch dates of Checkpoint records where
+    it used to convert a struct_time with time.mktime().
+    """
+    old_list = [cp for cp in cps
+                if (now - cp['date']) > protection_max and cp['ss']]
+    cps = [cp for cp in cps
+           if (now - cp['date']) < protection_max and
+              (now - cp['date']) > protection_period and
+              cp['ss']]
+    if len(cps) == 0:
+        return [], old_list
+
+    prev = cps.pop(0)
+    prev_mtime = prev['date']
+    group_start_mtime = prev_mtime
+
+    landmarks = []
+    targets = []
+    for cp in cps:
+        mtime = cp['date']
+        if ((mtime - prev_mtime) > interval or
+            (mtime - group_start_mtime) > threshold):
+            landmarks.append(prev)
+            group_start_mtime = mtime
+        else:
+            targets.append(prev)
+
+        prev = cp
+        prev_mtime = cp['date']
+    landmarks.append(prev)
+
+    return landmarks, old_list + targets
+
+class FakeNILFS2:
+    device = '/dev/test'
+
+    def __init__(self, cps):
+        self.cps = cps
+
+    def lscp(self, index=1):
+        return [cp for cp in self.cps if cp.cno >= index]
+
+    def chcp_many(self, cnos, ss=False):
+        pass
+
+def random_history(rand, now):
+    "Return random checkpoints created before @now, oldest first."
+    cps = []
+    date = now - rand.randint(0, 4000)
+    for cno in xrange(rand.randint(1, 60), 0, -1):
+        cps.append(nilfs2.Checkpoint(cno, date, rand.random() < 0.7))
+        date -= rand.choice((1, 5, 30, 60, 61, 100, 600, 3000))
+    cps.reverse()
+    return cps
+
+class LandmarkTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.clock = nilfs2_sim.SimClock()
+        cls.dm = load_daemon(cls.clock)
+
+    def test_first_call(self):
+        rand = random.Random(SEED)
+        now = self.clock.now
+        for i in xrange(CASES):
+            cps = random_history(rand, now)
+            params = {'interval': rand.choice((10, 60, 120)),
+                      'threshold': rand.choice((60, 600, 1200)),
+                      'protection_period': rand.choice((0, 60, 600)),
+                      'protection_max': rand.choice((1800, 3600, 7200))}
+            manager = self.dm.NILFSSSManager(FakeNILFS2(cps), '/',
+                                             self.dm.Logger(), **params)
+            landmarks, targets = manager.__find_landmarks__()
+            old = old_landmarks(cps, now, **params)
+            self.assertEqual(sorted(cp.cno for cp in landmarks),
+                             sorted(cp.cno for cp in old[0]),
+                             "case %d: landmarks of %r with %r" %
+                             (i, cps, params))
+            self.assertEqual([cp.cno for cp in targets],
+                             sorted(cp.cno for cp in old[1]),
+                             "case %d: targets of %r with %r" %
+                             (i, cps, params))
+
+    def test_passes(self):
+        rand = random.Random(SEED)
+        for i in xrange(CASES / 10):
+            now = self.clock.now = 1300000000
+            cps = random_history(rand, now)
+            params = {'interval': rand.choice((10, 60, 120)),
+                      'threshold': rand.choice((30, 60, 600, 1200)),
+                      'protection_period': rand.choice((0, 60, 600)),
+                      'protection_max': rand.choice((1800, 3600, 7200))}
+            manager = self.dm.NILFSSSManager(FakeNILFS2(cps), '/',
+                                             self.dm.Logger(), **params)
+            manager.protected = set(cp.cno for cp in cps
+                                    if rand.random() < 0.05)
+            for step in xrange(50):
+                targets = manager.__find_landmarks__()[1]
+                old = old_landmarks(cps, self.clock.now, **params)[1]
+                self.assertEqual([cp.cno for cp in targets],
+                                 sorted(cp.cno for cp in old
+                                        if cp.cno not in manager.protected),
+                                 "case %d, step %d: %r with %r" %
+                                 (i, step, cps, params))
+                manager.chcp_many([cp for cp in targets
+                                   if rand.random() < 0.9])
+                manager.__deferred__ = [cp for cp in targets if cp.ss]
+                self.clock.now += rand.choice((1, 5, 30, 60, 300))
+                for j in xrange(rand.choice((0, 0, 1, 3))):
+                    cps.append(nilfs2.Checkpoint(
+                        cps[-1].cno + 1, self.clock.now - rand.randint(0, 5),
+                        rand.random() < 0.7))
+                manager.cps = cps
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    for name in ('--seed', '--cases'):
+        if name in args:
+            i = args.index(name)
+            globals()[name[2:].upper()] = int(args[i + 1])
+            del args[i:i + 2]
+    unittest.main(argv=sys.argv[:1] + args)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of reopening the mount table.
+
+MountTable must open its file again after its descriptor was closed
+behind its back, without closing the number which someone else may
+have got since, and after a fork, closing the descriptor it then
+leaves behind.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import nilfs2
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+class MountTableTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        self.path = os.path.join(self.root, 'mounts')
+        with open(self.path, 'w') as f:
+            f.write("/dev/sim /vol nilfs2 rw,relatime 0 0\n"
+                    "/dev/sim /snap nilfs2 ro,relatime,cp=5 0 0\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_closed(self):
+        table = nilfs2.MountTable(self.path)
+        os.close(table.fd)
+        # The number is reused by someone else
+        other = os.open(os.devnull, os.O_RDONLY)
+        try:
+            self.assertEqual(table.by_mount_point('/vol').dev, '/dev/sim')
+            os.fstat(other)
+        finally:
+            os.close(other)
+        os.close(table.fd)
+
+    def test_forked(self):
+        table = nilfs2.MountTable(self.path)
+        fds = open_fds()
+        for i in xrange(10):
+            table.pid = -1   # as if the process was forked
+            self.assertEqual(table.nilfs_snapshots('/dev/sim'),
+                             [('/snap', 5)])
+            self.assertEqual(table.pid, os.getpid())
+        self.assertEqual(open_fds(), fds)
+        os.close(table.fd)
+
+if __name__ == '__main__':
+    unittest.main()
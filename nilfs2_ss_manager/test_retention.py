@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of the retention tiers.
+
+Like the sparse parameters, the tiers and max_snapshots must keep
+the snapshots in their protection period, and the targets which
+could not be thinned out on the last call, as busy snapshots, must
+stay targets.  Booleans are not accepted as numbers in their
+configuration.
+"""
+
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+class FakeNILFS2:
+    device = '/dev/test'
+
+    def __init__(self, cps):
+        self.cps = cps
+
+    def lscp(self, index=1):
+        return [cp for cp in self.cps if cp.cno >= index]
+
+class RetentionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = nilfs2_sim.SimClock()
+        self.dm = load_daemon(self.clock)
+        # A snapshot every ten minutes for two days
+        self.cps = [nilfs2.Checkpoint(i + 1, self.clock.now - 2 * DAY +
+                                      i * 600, True)
+                    for i in xrange(2 * 24 * 6)]
+
+    def manager(self, tiers, max_snapshots=None):
+        return self.dm.NILFSSSManager(
+            FakeNILFS2(self.cps), '/', self.dm.Logger(), interval=60,
+            threshold=600, protection_period=DAY, protection_max=365 * DAY,
+            retention=self.dm.RetentionPolicy(tiers, max_snapshots))
+
+    def test_protection_period(self):
+        recent = self.clock.now - DAY
+        # Everything is older than the only tier
+        targets = self.manager([(HOUR, 0)]).thinning_targets()
+        self.assertTrue(targets)
+        self.assertTrue(all(cp.date < recent for cp in targets))
+        self.assertEqual(len(targets),
+                         len([cp for cp in self.cps if cp.date < recent]))
+        targets = self.manager(None, 10).thinning_targets()
+        self.assertTrue(all(cp.date < recent for cp in targets))
+
+    def test_deferred(self):
+        manager = self.manager([(3 * DAY, 0)])
+        self.assertEqual(manager.thinning_targets(), [])
+        busy = self.cps[3]
+        manager.__deferred__ = [busy]
+        self.assertEqual(manager.thinning_targets(), [busy])
+        manager.protected.add(busy.cno)
+        self.assertEqual(manager.thinning_targets(), [])
+
+    def test_configuration(self):
+        for conf, valid in (({'retention': [[HOUR, 0], [DAY, 600]]}, True),
+                            ({'retention': [[HOUR, True]]}, False),
+                            ({'retention': [[False, 0]]}, False),
+                            ({'max_snapshots': 100}, True),
+                            ({'max_snapshots': True}, False)):
+            conf.update({'devices': {'/dev/test': '/'}, 'period': 5,
+                         'pidfile': '/var/run/test.pid'})
+            try:
+                self.dm.check_configuration(conf)
+            except self.dm.NILFSConfigurationException:
+                self.assertFalse(valid, conf)
+            else:
+                self.assertTrue(valid, conf)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of incremental thinning over years on a simulated clock.
+
+A snapshot is taken on a simulated volume at a random time in every
+hour for two years, while the manager thins out snapshots every hour
+or every day.  On every tick, the manager must keep the same
+snapshots as the full scan it replaced, old_landmarks() from
+test_landmarks, run on the snapshots left by the previous ticks.
+Snapshots left when the tick budget is used up are thinned out by
+the following ticks.
+"""
+
+import os
+import random
+import shutil
+import syslog
+import tempfile
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+from test_landmarks import old_landmarks
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+YEARS = 2
+
+PARAMS = {'interval': 2 * HOUR, 'threshold': DAY,
+          'protection_period': DAY, 'protection_max': 365 * DAY}
+
+class ThinningTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def simulate(self, tick):
+        """
+        Run the manager over the history with a tick every @tick
+        seconds, and check the snapshots it keeps after every tick
+        against the full scan on a copy of the snapshots.
+        """
+        clock = nilfs2_sim.SimClock()
+        dm = load_daemon(clock)
+        volume = nilfs2_sim.SimVolume(clock)
+        mounts = nilfs2_sim.SimMounts(volume)
+        ns = nilfs2.NILFS2(volume.device, nilfs2_sim.SimBackend(volume))
+        manager = dm.NILFSSSManager(
+            ns, self.root,
+            dm.Logger(priomask=syslog.LOG_UPTO(syslog.LOG_WARNING)),
+            **PARAMS)
+        mounts.attach(manager)
+        rand = random.Random(1)
+        expected = []
+        for hour in xrange(YEARS * 365 * 24):
+            date = clock.now + rand.randint(1, HOUR - 1)
+            clock.now += HOUR
+            cp = volume.checkpoint(True, date)
+            expected.append(nilfs2.Checkpoint(cp.cno, cp.date, True))
+            if (hour + 1) % (tick / HOUR) == 0:
+                manager.update()
+                thinned = set(cp.cno for cp in
+                              old_landmarks(expected, clock.now, **PARAMS)[1])
+                expected = [cp for cp in expected if cp.cno not in thinned]
+                self.assertEqual(self.kept(volume),
+                                 set(cp.cno for cp in expected),
+                                 "hour %d" % hour)
+        # The cache agrees with the volume
+        self.assertEqual(set(cp.cno for cp in manager.cps
+                             if cp.ss and cp.cno > 1), self.kept(volume))
+        return manager
+
+    def kept(self, volume):
+        return set(cp.cno for cp in volume.iter_from(2) if cp.ss)
+
+    def test_hourly(self):
+        manager = self.simulate(HOUR)
+        # Only the runs which can change are grouped again
+        self.assertTrue(len(manager.__open__) <= 2)
+
+    def test_daily(self):
+        self.simulate(DAY)
+
+    def test_budget(self):
+        clock = nilfs2_sim.SimClock()
+        dm = load_daemon(clock)
+        volume = nilfs2_sim.SimVolume(clock)
+        for i in xrange(100):
+            volume.checkpoint(True, clock.now - 400 * DAY + i * HOUR)
+        ns = nilfs2.NILFS2(volume.device, nilfs2_sim.SimBackend(volume))
+        manager = dm.NILFSSSManager(
+            ns, self.root,
+            dm.Logger(priomask=syslog.LOG_UPTO(syslog.LOG_WARNING)),
+            **PARAMS)
+        nilfs2_sim.SimMounts(volume).attach(manager)
+        manager.CHCP_BATCH = 30
+        # Every tick thins out one batch once the budget is used up
+        manager.deadline = clock.now - 1
+        for left in (70, 40, 10, 0):
+            manager.update()
+            self.assertEqual(len(self.kept(volume)), left)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Tests of unmounting the snapshots to be thinned out.
+
+Snapshots unmounted by the UnmountPool must lose their mount points
+in the cache, and a snapshot which stays busy past the deadline must
+be left mounted for longer and longer, rather than submitted again
+on every tick, with a single message logged about it.
+"""
+
+import shutil
+import syslog
+import tempfile
+import time
+import unittest
+
+import nilfs2
+import nilfs2_sim
+from bench_manager import load_daemon
+
+DAY = 24 * 60 * 60
+
+class Logger:
+    def __init__(self):
+        self.messages = []
+
+    def out(self, prio, string):
+        self.messages.append((prio, string))
+
+class UnmountTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nilfs2-test-')
+        self.clock = nilfs2_sim.SimClock()
+        self.dm = load_daemon(self.clock)
+        self.volume = nilfs2_sim.SimVolume(self.clock)
+        for i in xrange(5):
+            self.volume.checkpoint(True, self.clock.now - 400 * DAY + i * 60)
+        ns = nilfs2.NILFS2(self.volume.device,
+                           nilfs2_sim.SimBackend(self.volume))
+        self.logger = Logger()
+        self.manager = self.dm.NILFSSSManager(
+            ns, self.root, self.logger, interval=60, threshold=600,
+            protection_period=3600, protection_max=365 * DAY)
+        self.mounts = nilfs2_sim.SimMounts(self.volume)
+        self.mounts.attach(self.manager)
+        self.pool = self.dm.UnmountPool(1, self.logger, deadline=0)
+        self.manager.unmounter = self.pool
+        self.cps = [cp for cp in self.manager.cps if cp.ss]
+        for cp in self.cps:
+            self.manager.do_mount(cp)
+
+    def tearDown(self):
+        self.pool.stop()
+        shutil.rmtree(self.root)
+
+    def update(self):
+        self.manager.update()
+        while self.pool.pending:
+            time.sleep(0.01)
+
+    def test_busy(self):
+        busy = self.cps[2]
+        self.mounts.busy.add(busy.mp)
+        self.update()
+        self.assertEqual([cp.cno for cp in self.cps if cp.has_key('mp')],
+                         [busy.cno])
+        self.update()
+        self.assertEqual([cp.cno for cp in self.volume.iter_from(2)
+                          if cp.ss], [busy.cno])
+        # Left mounted until the wait is over, then tried again
+        umounts = self.volume.calls['umount']
+        self.update()
+        self.assertEqual(self.volume.calls['umount'], umounts)
+        self.clock.now += self.manager.BUSY_WAIT + 1
+        self.update()
+        self.assertEqual(self.volume.calls['umount'], umounts + 1)
+        self.assertEqual(self.manager.__busy__[busy.cno][1],
+                         2 * self.manager.BUSY_WAIT)
+        self.assertEqual(len([prio for prio, string in self.logger.messages
+                              if prio <= syslog.LOG_NOTICE]), 1)
+
+        self.mounts.busy.discard(busy.mp)
+        self.clock.now += 2 * self.manager.BUSY_WAIT + 1
+        self.update()
+        self.update()
+        self.assertFalse(busy.has_key('mp'))
+        self.assertEqual([cp for cp in self.volume.iter_from(2) if cp.ss],
+                         [])
+        self.assertEqual(self.manager.__busy__, {})
+
+if __name__ == '__main__':
+    unittest.main()